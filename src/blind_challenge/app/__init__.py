@@ -2,13 +2,16 @@ import os
 import sys
 import logging
 from collections import OrderedDict
+import threading
 
-from flask import Flask, g, current_app
+from flask import Flask, g, current_app, request
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_login import LoginManager
 
+from .cache import FileCache
 from .config import config
+from .listing import EMPTY_LISTING
 from .models import User
 
 
@@ -24,6 +27,7 @@ lm.login_view = 'login'
 log_format = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
 logging.basicConfig(level=logging.INFO, stream=sys.stdout,
                     format=log_format, datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger(__name__)
 
 
 @lm.user_loader
@@ -34,6 +38,30 @@ def load_user(user_id):
 moment = Moment(app)
 
 TABLE_DICT = OrderedDict()
+LISTING = EMPTY_LISTING  # latest ListingSnapshot, replaced on each refresh
+_publish_lock = threading.Lock()
+
+DOWNLOAD_CACHE = None
+if app.config['DOWNLOAD_CACHE_MAX_MB'] > 0:
+    DOWNLOAD_CACHE = FileCache(app.config['DOWNLOAD_CACHE_DIR'],
+                               max_bytes=int(app.config['DOWNLOAD_CACHE_MAX_MB'] * 1e6))
+
+ZIP_STORE = None
+ALL_FILES_SCOPE = 'all'  # ZIP_STORE scope for archive of every drive
+if app.config['PREBUILD_ZIPS']:
+    from .archive import ZipStore
+    ZIP_STORE = ZipStore(app.config['ZIP_DIR'],
+                         cache=DOWNLOAD_CACHE,
+                         chunk_size=app.config['DOWNLOAD_CHUNK_SIZE'],
+                         workers=app.config['ZIP_FETCH_WORKERS'],
+                         member_timeout=app.config['ZIP_MEMBER_TIMEOUT'],
+                         member_retries=app.config['ZIP_MEMBER_RETRIES'])
+
+PROFILE_STORE = None
+if (app.config['PROFILE_SAMPLE_RATE'] > 0 or app.config['PROFILE_TOKEN']
+        or app.config['PROFILE_REFRESHES']):
+    from .profiling import ProfileStore
+    PROFILE_STORE = ProfileStore(app.config['PROFILE_DIR'], keep=app.config['PROFILE_KEEP'])
 
 
 @app.before_request
@@ -42,17 +70,43 @@ def before_request():
 
 
 def update_g():
-    # get cols_show and dictionary of tables
-    tables = TABLE_DICT.copy()
-    cols_show = tables[next(iter(tables))].cols_show
-    for i in tables:
-        tables[i] = tables[i].df
-    g.tables = tables
-    g.cols_show = cols_show
+    """Point request at the latest listing snapshot, refreshing stale drives."""
+    if request.endpoint == 'static':
+        return
+    for table in TABLE_DICT.values():
+        if table.is_stale:
+            table.refresh_in_background()
+    listing = LISTING
+    g.listing = listing
+    g.tables = listing.tables
+    g.cols_show = listing.cols_show
+    g.file_index = listing.file_index
+
+
+def publish_listing(table=None):
+    """Replace LISTING with a snapshot including the latest drive listings.
+
+    Args:
+        table (DriveTable): refreshed table, or None to start afresh from
+            all tables in TABLE_DICT.
+    """
+    global LISTING
+    with _publish_lock:
+        if table is None:
+            LISTING = EMPTY_LISTING.replace(TABLE_DICT, version=LISTING.version + 1)
+        else:
+            names = [name for name, t in TABLE_DICT.items() if t is table]
+            LISTING = LISTING.replace({name: table for name in names})
+    logger.info('Published listing {}.'.format(LISTING))
 
 
 @app.before_first_request
-def update_drive_listing():
+def update_drive_listing(use_snapshot=True):
+    """Set up drive tables, loading saved listing snapshots if present.
+
+    Tables loaded from a stale snapshot are refreshed in the background when
+    first read. With use_snapshot=False, drives are crawled straight away.
+    """
     from .admin import DriveTable
 
     drive_id_a = current_app.config['DRIVE_ID_A']
@@ -61,11 +115,41 @@ def update_drive_listing():
     drive_id_b = current_app.config['DRIVE_ID_B']
     drive_name_b = current_app.config['DRIVE_NAME_B']
 
+    crawl_opts = dict(crawl_mode=current_app.config['DRIVE_CRAWL_MODE'],
+                      crawl_workers=current_app.config['DRIVE_CRAWL_WORKERS'],
+                      incremental=current_app.config['DRIVE_INCREMENTAL_REFRESH'],
+                      refresh_minutes=current_app.config['DRIVE_REFRESH_MINUTES'],
+                      snapshot_dir=current_app.config['SNAPSHOT_DIR'],
+                      load_snapshot=use_snapshot)
+
     TABLE_DICT.clear()
     TABLE_DICT.update({
-        drive_name_a: DriveTable(drive_id_a, drive_name_a),
-        drive_name_b: DriveTable(drive_id_b, drive_name_b),
+        drive_name_a: DriveTable(drive_id_a, drive_name_a, **crawl_opts),
+        drive_name_b: DriveTable(drive_id_b, drive_name_b, **crawl_opts),
     })
+    for table in TABLE_DICT.values():
+        table.refresh_callbacks.extend([publish_listing, update_zips])
+    publish_listing()
+    update_zips()
+
+
+def update_zips(table=None):
+    """Start background builds of zips for drives whose listings have changed.
+
+    Args:
+        table (DriveTable): refreshed table, or None to check all drives.
+    """
+    import pandas as pd
+
+    if ZIP_STORE is None:
+        return
+    listing = LISTING
+    for name, drive_table in TABLE_DICT.items():
+        if table is None or drive_table is table:
+            ZIP_STORE.update(name, listing.tables[name], base_path=name)
+    all_files = pd.concat(listing.tables.values(),
+                          axis=0, ignore_index=True, sort=False)
+    ZIP_STORE.update(ALL_FILES_SCOPE, all_files)
 
 
 from .import routes
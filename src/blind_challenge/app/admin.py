@@ -1,48 +1,247 @@
 from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import queue
+import threading
+import time
 from datetime import date, datetime, timezone, timedelta
 
-import pandas as pd
-from flask import current_app
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from flask import current_app, has_app_context
 # from httplib2 import Http
 # from oauth2client import file, client, tools
 
-from .helpers import parse_timestamp_str
-from .drive import file_tree_to_df
+from .helpers import atomic_write, save_pickle, load_pickle, make_private_dir
+from .metrics import REFRESH_SECONDS, REFRESH_FAILURES, LAST_REFRESH, LISTING_FILES
+from .profiling import maybe_profile
+from .search import SearchIndex
+from .drive import (file_tree_to_df, get_drive_files, listing_to_df,
+                    get_start_page_token, get_changes, apply_changes, index_files)
 
 
-def get_service_handles():
-    """Get dictionary of {service_name: service_handle}."""
-    SERVICE_ACCOUNT_FILE = current_app.config['SERVICE_ACCOUNT_FILE']
-    # GROUP_KEY = current_app.config['GROUP_KEY']
-    SCOPES = current_app.config['SCOPES']
+logger = logging.getLogger(__name__)
+
+
+def get_config():
+    """Get app config, also from threads without an app context."""
+    if has_app_context():
+        return current_app.config
+    from . import app
+    return app.config
+
+
+def get_refresh_profile_store():
+    """Get ProfileStore for refresh profiles, or None if they are off."""
+    from . import PROFILE_STORE
+    return PROFILE_STORE if get_config()['PROFILE_REFRESHES'] else None
+
+
+def get_credentials():
+    """Get service account credentials delegated to CREDENTIALS_AS_USER."""
+    from google.oauth2 import service_account
+
+    config = get_config()
+    SERVICE_ACCOUNT_FILE = config['SERVICE_ACCOUNT_FILE']
+    # GROUP_KEY = config['GROUP_KEY']
+    SCOPES = config['SCOPES']
 
     credentials = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
     delegated_credentials = credentials.with_subject(
-        current_app.config['CREDENTIALS_AS_USER']
+        config['CREDENTIALS_AS_USER']
     )
+    return delegated_credentials
 
-    files_service = build('drive', 'v3', credentials=delegated_credentials,
-                          cache_discovery=False)
+
+def get_service_handles(credentials=None):
+    """Get dictionary of {service_name: service_handle}."""
+    if credentials is None:
+        credentials = get_credentials()
+    files_service = build_service('drive', 'v3', credentials,
+                                  discovery_dir=get_config()['DISCOVERY_DIR'])
     return {
         'files': files_service,
     }
 
 
-SERVICE_HANDLES = get_service_handles()
+def build_service(service_name, version, credentials, discovery_dir=None):
+    """Build API service, from discovery document saved on disk if present.
+
+    Otherwise the service is built as usual and its discovery document saved
+    for next time, so later starts don't fetch and parse it again.
+    """
+    from googleapiclient.discovery import build, build_from_document
+
+    doc_path = None
+    if discovery_dir:
+        doc_path = os.path.join(discovery_dir, '{}.{}.json'.format(service_name, version))
+        try:
+            make_private_dir(discovery_dir)
+            with open(doc_path) as f:
+                return build_from_document(f.read(), credentials=credentials)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            logger.exception("Not using discovery directory %s.", discovery_dir)
+            doc_path = None
+        except Exception:
+            logger.exception("Ignoring bad discovery document %s.", doc_path)
+    service = build(service_name, version, credentials=credentials,
+                    cache_discovery=False)
+    if doc_path is not None:
+        try:
+            with atomic_write(doc_path, mode='w') as f:
+                json.dump(service._rootDesc, f)
+        except OSError:
+            logger.exception("Failed to save discovery document %s.", doc_path)
+    return service
+
+
+_credentials = None
+_service_handles = {}
+_services_lock = threading.Lock()
+
+
+def get_shared_credentials():
+    """Get credentials shared by all services, created on first use."""
+    global _credentials
+    with _services_lock:
+        if _credentials is None:
+            _credentials = get_credentials()
+        return _credentials
+
+
+def get_service(name):
+    """Get service handle by name, e.g. 'files', built on first use."""
+    credentials = get_shared_credentials()
+    with _services_lock:
+        if not _service_handles:
+            _service_handles.update(get_service_handles(credentials))
+        return _service_handles[name]
+
+
+class HttpPool:
+    """Authorized http connections shared by threads, checked out per request.
+
+    httplib2 connections are not thread-safe, so each request is made on a
+    connection no other thread is using. Connections are kept for reuse, so
+    keep-alive sessions survive between requests, and all share one set of
+    credentials, so the token is refreshed once for the pool. Used in place
+    of an httplib2.Http, e.g. request.execute(http=pool).
+
+    Args:
+        credentials (google.auth.credentials.Credentials): shared credentials.
+        size (int): maximum number of connections. Requests wait for a free
+            connection once all are in use.
+        http_factory (callable): makes an unauthorized httplib2.Http-like
+            connection, googleapiclient's build_http by default.
+    """
+
+    def __init__(self, credentials, size=10, http_factory=None):
+        self.credentials = credentials
+        self.size = size
+        self.http_factory = http_factory
+        self.created = 0
+        self._idle = queue.LifoQueue()  # most recently used first, likely still open
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Check out authorized connection for the calling thread."""
+        http = self._checkout()
+        try:
+            yield http
+        finally:
+            self._idle.put(http)
+
+    def request(self, *args, **kwargs):
+        """Make request on a free connection, like httplib2.Http.request."""
+        with self.connection() as http:
+            self._refresh_token(http)
+            return http.request(*args, **kwargs)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self._new_connection()
+        except Exception:
+            with self._lock:
+                self.created -= 1
+            raise
+
+    def _new_connection(self):
+        from google_auth_httplib2 import AuthorizedHttp
+
+        if self.http_factory is None:
+            from googleapiclient.http import build_http
+            self.http_factory = build_http
+        return AuthorizedHttp(self.credentials, http=self.http_factory())
+
+    def _refresh_token(self, http):
+        """Refresh shared token if needed, in one thread only."""
+        if self.credentials.valid:
+            return
+        from google_auth_httplib2 import Request
+
+        with self._refresh_lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(Request(http.http))
+
+
+_http_pool = None
+
+
+def get_http_pool():
+    """Get HttpPool shared by all Drive requests, created on first use."""
+    global _http_pool
+    credentials = get_shared_credentials()
+    with _services_lock:
+        if _http_pool is None:
+            _http_pool = HttpPool(credentials, size=get_config()['DRIVE_HTTP_POOL_SIZE'])
+        return _http_pool
 
 
 class ApiTable:
+    """Table of API data, refreshed in the background once stale.
+
+    Reading df always returns the last good data straight away. If the data
+    is stale, a refresh is started on a background thread, at most one at a
+    time per table. refresh_df implementations should build the new data
+    and assign it to self._df in one step, so readers never see a partial
+    refresh, and a failed refresh leaves the previous data in place.
+    """
     cols_show = None  # subclasses will override
     cols_other = None
 
-    def __init__(self):
+    def __init__(self, refresh_minutes=1):
         self._df = None  # subclasses will override
         self.last_refresh = datetime.utcnow()
-        self.refresh_minutes = 1
-        self.refresh_df()
+        self.refresh_minutes = refresh_minutes
+        self.refresh_callbacks = []  # called with table after background refreshes
+        self._refresh_lock = threading.Lock()
+        if not self.load_saved():
+            self.refresh_df()
+
+    def load_saved(self):
+        """Load previously saved data, for subclasses that persist data.
+
+        Implementations should set last_refresh to when the data was saved.
+
+        Returns:
+            bool: whether data was loaded.
+        """
+        return False
 
     def refresh_df(self):
         """Subclasses will override this method."""
@@ -52,12 +251,49 @@ class ApiTable:
     def cols(self):
         return list(self.cols_show) + list(self.cols_other)
 
+    @property
+    def is_stale(self):
+        return datetime.utcnow() > (self.last_refresh + timedelta(minutes=self.refresh_minutes))
+
     @property
     def df(self):
-        if datetime.utcnow() > (self.last_refresh + timedelta(minutes=self.refresh_minutes)):
+        if self.is_stale:
+            self.refresh_in_background()
+        return self._df
+
+    @property
+    def current_df(self):
+        """Last good data, without starting a refresh."""
+        return self._df
+
+    def refresh_in_background(self):
+        """Start refresh thread, unless a refresh is already running.
+
+        Returns:
+            bool: whether a refresh was started.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        thread = threading.Thread(target=self._run_refresh, daemon=True,
+                                  name='refresh-{}'.format(type(self).__name__))
+        thread.start()
+        return True
+
+    def _run_refresh(self):
+        try:
             self.refresh_df()
+        except Exception:
+            logger.exception("Refresh failed for %s. Keeping previous data.", self)
+            return
+        finally:
+            # on failure too, so a broken refresh isn't retried on every request
             self.last_refresh = datetime.utcnow()
-        return self._df
+            self._refresh_lock.release()
+        for callback in self.refresh_callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("Refresh callback failed for %s.", self)
 
     @staticmethod
     def _get_utc_naive(dt):
@@ -66,24 +302,146 @@ class ApiTable:
 
 
 class DriveTable(ApiTable):
+    """Listing of all files in a shared drive.
+
+    In 'flat' crawl mode with incremental refresh, the whole-drive listing and
+    a changes page token are kept between refreshes, so later refreshes only
+    fetch the changes since the last one. A full crawl is made on first load
+    and whenever applying changes fails.
+
+    Each refresh also rebuilds index, a {file_id: FileRecord} dict for
+    looking up files without scanning the listing, and search_index, a
+    SearchIndex of titles and folder paths.
+    """
 
-    def __init__(self, root_folder_id, root_folder_title):
-        self.refresh_minutes = 5
+    def __init__(self, root_folder_id, root_folder_title, crawl_mode='flat',
+                 crawl_workers=1, incremental=True, refresh_minutes=5,
+                 snapshot_dir=None, load_snapshot=True):
         self.root_folder_id = root_folder_id
         self.root_folder_title = root_folder_title
-        super().__init__()
+        self.crawl_mode = crawl_mode
+        self.crawl_workers = crawl_workers
+        self.incremental = incremental and crawl_mode == 'flat'
+        self.index = {}  # will hold {file_id: FileRecord}
+        self.search_index = None
+        self._listing = None  # whole-drive listing, for incremental refresh
+        self._page_token = None  # Changes API start page token
+        self.load_snapshot = load_snapshot
+        self.snapshot_path = None
+        if snapshot_dir:
+            make_private_dir(snapshot_dir)
+            self.snapshot_path = os.path.join(snapshot_dir, '{}.pickle'.format(root_folder_id))
+        super().__init__(refresh_minutes=refresh_minutes)
+
+    def __repr__(self):
+        return '<DriveTable {}>'.format(self.root_folder_title)
 
     cols_show = OrderedDict([
         ('title', 'Document'),
         ('date_modified', 'Modified'),
     ])
     cols_other = ['path', 'path_show', 'date_created', 'icon', 'id', 'kind',
-                  'last_user', 'mimeType', 'thumb', 'url_content', 'url_view']
+                  'last_user', 'md5', 'mimeType', 'thumb', 'url_content', 'url_view']
+    snapshot_format = 2  # bump when listing representation changes
 
     def refresh_df(self):
-        files = file_tree_to_df(self.root_folder_id, self.root_folder_title)
+        with maybe_profile(get_refresh_profile_store(), 'refresh', self.root_folder_title):
+            self._refresh()
+
+    def _refresh(self):
+        drive_name = self.root_folder_title
+        refreshed = False
+        if self._page_token is not None:
+            try:
+                with REFRESH_SECONDS.labels(drive_name, 'changes').time():
+                    self._refresh_from_changes()
+                refreshed = True
+            except Exception:
+                logger.exception("Incremental refresh failed for drive %s. "
+                                 "Re-crawling.", drive_name)
+        if not refreshed:
+            try:
+                with REFRESH_SECONDS.labels(drive_name, 'crawl').time():
+                    self._refresh_from_crawl()
+            except Exception:
+                REFRESH_FAILURES.labels(drive_name).inc()
+                raise
+        LAST_REFRESH.labels(drive_name).set(time.time())
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        """Write listing to snapshot file, for fast startup."""
+        if self.snapshot_path is None:
+            return
+        snapshot = {
+            'format': self.snapshot_format,
+            'root_folder_id': self.root_folder_id,
+            'saved': datetime.utcnow(),
+            'df': self._df,
+            'listing': self._listing,
+            'page_token': self._page_token,
+        }
+        try:
+            save_pickle(snapshot, self.snapshot_path)
+        except OSError:
+            logger.exception("Failed to save snapshot for drive %s.", self.root_folder_title)
+
+    def load_saved(self):
+        """Load listing from snapshot file, if present."""
+        if self.snapshot_path is None or not self.load_snapshot:
+            return False
+        start = time.perf_counter()
+        try:
+            snapshot = load_pickle(self.snapshot_path)
+        except Exception:
+            logger.exception("Failed to load snapshot for drive %s.", self.root_folder_title)
+            return False
+        if (snapshot is None or snapshot.get('format') != self.snapshot_format
+                or snapshot['root_folder_id'] != self.root_folder_id):
+            return False
+        self._set_files(snapshot['df'])
+        if self.incremental:
+            self._listing = snapshot['listing']
+            self._page_token = snapshot['page_token']
+        self.last_refresh = snapshot['saved']
+        LAST_REFRESH.labels(self.root_folder_title).set(
+            snapshot['saved'].replace(tzinfo=timezone.utc).timestamp())
+        logger.info("Loaded snapshot for drive %s (%d rows, saved %s) in %.3f s.",
+                    self.root_folder_title, len(self._df), snapshot['saved'],
+                    time.perf_counter() - start)
+        return True
+
+    def _refresh_from_crawl(self):
+        """Rebuild listing from a full crawl of the drive."""
+        if self.incremental:
+            # get token before listing so no change is missed
+            page_token = get_start_page_token(self.root_folder_id)
+            listing = get_drive_files(self.root_folder_id)
+            files = listing_to_df(listing, self.root_folder_id, self.root_folder_title)
+            self._listing, self._page_token = listing, page_token
+        else:
+            files = file_tree_to_df(self.root_folder_id, self.root_folder_title,
+                                    flat=self.crawl_mode == 'flat',
+                                    max_workers=self.crawl_workers)
+        self._set_files(files)
+
+    def _refresh_from_changes(self):
+        """Update listing with changes since the last refresh."""
+        changes, page_token = get_changes(self.root_folder_id, self._page_token)
+        if changes:
+            listing = apply_changes(self._listing, changes)
+            files = listing_to_df(listing, self.root_folder_id, self.root_folder_title)
+            self._set_files(files)
+            self._listing = listing
+        self._page_token = page_token
+
+    def _set_files(self, files):
         if len(files):
             cols_present = [i for i in DriveTable.cols_other if i in files.columns]
             files = files[list(DriveTable.cols_show) + cols_present]
             files = files.sort_values(['path', 'mimeType', 'title'])
-        self._df = files
+        index = index_files(files, drive=self.root_folder_title)
+        search_index = SearchIndex(files, drive=self.root_folder_title,
+                                   previous=self.search_index)
+        self._df, self.index, self.search_index = files, index, search_index
+        LISTING_FILES.labels(self.root_folder_title).set(len(files))
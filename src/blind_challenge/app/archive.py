@@ -0,0 +1,154 @@
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+from .drive import is_permanent_error, iter_folder_zip, listing_fingerprint
+from .helpers import atomic_write, make_private_dir
+
+
+logger = logging.getLogger(__name__)
+
+
+class ZipStore:
+    """Zip archives of listings, built in the background and kept on disk.
+
+    Archives are stored per scope (e.g. a drive name) under the fingerprint
+    of the listing they were built from, and only rebuilt when that changes.
+    The previous archive stays available while a new one is built. A build
+    with files that failed to fetch for a reason that may pass, such as a
+    server error or timeout, is discarded so it is tried again on the next
+    update. Files that can never be fetched, such as forms, are listed in
+    the archive's MISSING_FILES.txt instead. Build locks are files, so processes sharing
+    the directory don't duplicate work.
+
+    Args:
+        directory (str): directory for archives, created if missing.
+        keep (int): archives to keep per scope, newest first.
+        **zip_kwargs: passed to iter_folder_zip.
+    """
+    lock_timeout = 3600  # seconds after which a build lock is presumed stale
+
+    def __init__(self, directory, keep=2, **zip_kwargs):
+        self.directory = directory
+        self.keep = keep
+        self.zip_kwargs = zip_kwargs
+        make_private_dir(directory)
+        self._pending = {}  # will hold {scope: (newest listing waiting to be built, base path)}
+        self._builders = {}  # will hold {scope: builder thread}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _slug(scope):
+        return re.sub(r'[^\w-]', '_', scope)
+
+    def path(self, scope, fingerprint):
+        return os.path.join(self.directory, '{}-{}.zip'.format(self._slug(scope), fingerprint))
+
+    def _scope_paths(self, scope):
+        pattern = '{}-{}.zip'.format(glob.escape(self._slug(scope)), '[0-9a-f]' * 16)
+        return glob.glob(os.path.join(glob.escape(self.directory), pattern))
+
+    def latest(self, scope):
+        """Get path of newest complete archive for scope, or None."""
+        paths = self._scope_paths(scope)
+        if not paths:
+            return None
+        return max(paths, key=_mtime)
+
+    def update(self, scope, files_df, base_path=None):
+        """Start background build of archive for listing, unless already built.
+
+        Args:
+            scope (str): name of archive, e.g. drive name.
+            files_df (pd.DataFrame): listing of files to include.
+            base_path (str): listing path that member names are relative to.
+        """
+        if not len(files_df):
+            return
+        with self._lock:
+            self._pending[scope] = (files_df, base_path)
+            builder = self._builders.get(scope)
+            if builder is None or not builder.is_alive():
+                builder = threading.Thread(target=self._build_pending, args=(scope,),
+                                           daemon=True, name='zip-{}'.format(scope))
+                self._builders[scope] = builder
+                builder.start()
+
+    def _build_pending(self, scope):
+        while True:
+            with self._lock:
+                pending = self._pending.pop(scope, None)
+                if pending is None:
+                    del self._builders[scope]
+                    return
+            try:
+                self.build(scope, *pending)
+            except Exception:
+                logger.exception('Failed to build zip for {}.'.format(scope))
+
+    def build(self, scope, files_df, base_path=None):
+        """Build archive for listing if not present, then remove old archives.
+
+        Returns:
+            str: archive path, or None if another process is building it.
+        Raises:
+            RuntimeError: if any file couldn't be fetched because of an error
+                that may pass. No archive is kept.
+        """
+        fingerprint = listing_fingerprint(files_df)
+        path = self.path(scope, fingerprint)
+        if os.path.exists(path):
+            os.utime(path)  # mark as latest, in case listing has reverted
+            return path
+        lock_path = path + '.lock'
+        if not self._acquire(lock_path):
+            logger.info('Zip for {} is being built by another process.'.format(scope))
+            return None
+        try:
+            start = time.perf_counter()
+            missing = []
+            with atomic_write(path) as f:
+                for data in iter_folder_zip(files_df, base_path=base_path, missing=missing,
+                                            **self.zip_kwargs):
+                    f.write(data)
+                transient = [line for line, e in missing if not is_permanent_error(e)]
+                if transient:
+                    raise RuntimeError('Zip for {} left out {} files:\n{}'.format(
+                        scope, len(transient), '\n'.join(transient)))
+            logger.info('Built zip for {} in {:.1f} s: {}'.format(
+                scope, time.perf_counter() - start, path))
+        finally:
+            os.remove(lock_path)
+        self._remove_old(scope)
+        return path
+
+    def _acquire(self, lock_path):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            if time.time() - _mtime(lock_path) < self.lock_timeout:
+                return False
+        try:
+            os.remove(lock_path)  # stale lock from a build that died
+        except FileNotFoundError:
+            pass
+        return self._acquire(lock_path)
+
+    def _remove_old(self, scope):
+        paths = self._scope_paths(scope)
+        for path in sorted(paths, key=_mtime, reverse=True)[self.keep:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
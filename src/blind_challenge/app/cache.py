@@ -0,0 +1,267 @@
+from contextlib import contextmanager
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from .helpers import atomic_write, iter_file_chunks, make_private_dir
+from .metrics import CACHE_LOOKUPS
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """Size-limited on-disk cache of file contents with LRU eviction.
+
+    Entries are stored under a hash of their key, written atomically and
+    touched on each hit, so least recently used entries are evicted first.
+    Several processes can share one cache directory. Entries filled with
+    stream are readable by other threads while they are written.
+
+    Args:
+        directory (str): cache directory, created private to the current user
+            if missing.
+        max_bytes (int): total size above which entries are evicted.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        make_private_dir(directory)
+        self._key_locks = {}  # will hold {key: [lock, user count]}
+        self._key_locks_lock = threading.Lock()
+        self._fills = {}  # will hold {key: _Fill being written}
+
+    @staticmethod
+    def make_key(*parts):
+        """Get cache key from parts, e.g. file id, version and mime type."""
+        return hashlib.sha256('\0'.join(str(i) for i in parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def open(self, key):
+        """Open cached file for reading and mark it as used.
+
+        Returns:
+            file object, or None if key is not cached.
+        """
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            CACHE_LOOKUPS.labels('miss').inc()
+            return None
+        CACHE_LOOKUPS.labels('hit').inc()
+        try:
+            os.utime(path)
+        except OSError:  # evicted since opening, but still readable
+            pass
+        return f
+
+    def get(self, key):
+        """Get cached bytes, or None if key is not cached."""
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    @contextmanager
+    def writer(self, key):
+        """Open file for writing new entry, stored once closed without error."""
+        with atomic_write(self.path(key)) as f:
+            yield f
+        self.evict()
+
+    def put(self, key, data):
+        """Store bytes for key."""
+        with self.writer(key) as f:
+            f.write(data)
+
+    @contextmanager
+    def lock(self, key, timeout=-1):
+        """Hold lock for key within this process.
+
+        Lets concurrent misses for the same key wait for the first to fill
+        the cache rather than all fetching the data.
+
+        Args:
+            key (str): cache key.
+            timeout (float): most seconds to wait, or -1 to wait as long as
+                needed.
+        Yields:
+            bool: whether the lock was acquired before the timeout.
+        """
+        with self._key_locks_lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(timeout=timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._key_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def stream(self, key, download, chunk_size, timeout=-1):
+        """Get content for key in chunks, from cache or as it is downloaded.
+
+        On a miss, download() is called to start fetching the content, and a
+        background thread writes it to the cache, however fast the content
+        is read. Concurrent calls for the key read the same entry as it is
+        written, rather than downloading it again. The key's lock is only
+        held while looking up the entry and starting the download.
+
+        Args:
+            key (str): cache key.
+            download (callable): returns (chunks iterator, size or None).
+            chunk_size (int): maximum bytes per chunk read.
+            timeout (float): most seconds to wait for another call starting
+                the download, or -1 to wait as long as needed.
+        Returns:
+            (chunks, size, downloaded): content chunks, size in bytes or None
+                if unknown, and whether this call started the download. None
+                if timed out waiting.
+        """
+        with self.lock(key, timeout=timeout) as acquired:
+            if not acquired:
+                return None
+            fill = self._fills.get(key)
+            chunks = fill.reader(chunk_size) if fill is not None else None
+            if chunks is not None:
+                CACHE_LOOKUPS.labels('hit').inc()
+                return chunks, fill.size, False
+            f = self.open(key)
+            if f is not None:
+                return iter_file_chunks(f, chunk_size), os.fstat(f.fileno()).st_size, False
+            content, size = download()
+            fill = _Fill(self, key, size)
+            chunks = fill.reader(chunk_size)
+            self._fills[key] = fill
+            fill.start(content)
+            return chunks, size, True
+
+    def evict(self):
+        """Remove least recently used entries until within size limit."""
+        entries = []
+        total = 0
+        for dir_path, dir_names, file_names in os.walk(self.directory):
+            for name in file_names:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info('Evicted from cache: {}'.format(path))
+            if total <= self.max_bytes:
+                break
+
+
+class _Fill:
+    """Cache entry being written by a background thread, readable as it grows.
+
+    Args:
+        cache (FileCache): cache the entry is for.
+        key (str): cache key.
+        size (int): content length in bytes, or None if unknown.
+    """
+
+    def __init__(self, cache, key, size):
+        self.size = size
+        self._cache = cache
+        self._key = key
+        self._path = cache.path(key)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix='.tmp-')
+        self._file = os.fdopen(fd, 'wb')
+        self._written = 0
+        self._done = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def start(self, chunks):
+        """Start writing chunks to cache entry on a background thread."""
+        threading.Thread(target=self._write, args=(chunks,), daemon=True,
+                         name='cache-fill').start()
+
+    def _write(self, chunks):
+        error = None
+        try:
+            with self._file as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    f.flush()
+                    with self._cond:
+                        self._written += len(chunk)
+                        self._cond.notify_all()
+        except Exception as e:
+            error = e
+        with self._cond:
+            if error is None:
+                try:
+                    os.replace(self._tmp_path, self._path)
+                except OSError as e:
+                    error = e
+            self._error, self._done = error, True
+            self._cond.notify_all()
+        self._cache._fills.pop(self._key, None)
+        if error is None:
+            self._cache.evict()
+            return
+        logger.error('Failed to fill cache entry {}: {!r}'.format(self._key, error))
+        try:
+            os.remove(self._tmp_path)  # readers with the file open can still read it
+        except OSError:
+            pass
+
+    def reader(self, chunk_size):
+        """Get iterator over content, waiting for chunks not yet written.
+
+        Returns:
+            iterator of bytes chunks, or None if the entry failed or was
+                evicted as soon as written.
+        """
+        with self._cond:
+            if self._error is not None:
+                return None
+            try:
+                f = open(self._path if self._done else self._tmp_path, 'rb')
+            except FileNotFoundError:
+                return None
+        return self._read(f, chunk_size)
+
+    def _read(self, f, chunk_size):
+        position = 0
+        with f:
+            while True:
+                with self._cond:
+                    while position == self._written and not self._done:
+                        self._cond.wait()
+                    written, error = self._written, self._error
+                if position < written:
+                    chunk = f.read(min(chunk_size, written - position))
+                    position += len(chunk)
+                    yield chunk
+                elif error is not None:
+                    raise error
+                else:
+                    return
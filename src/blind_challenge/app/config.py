@@ -29,6 +29,51 @@ class Config(object):
     DRIVE_ID_B = os.environ.get('DRIVE_ID_B')
     DRIVE_NAME_A = os.environ.get('DRIVE_NAME_A')
     DRIVE_NAME_B = os.environ.get('DRIVE_NAME_B')
+    # 'flat' lists each drive in a few paged calls, 'folders' crawls folder by folder
+    DRIVE_CRAWL_MODE = os.environ.get('DRIVE_CRAWL_MODE', 'flat')
+    # number of folders fetched concurrently in 'folders' crawl mode
+    DRIVE_CRAWL_WORKERS = int(os.environ.get('DRIVE_CRAWL_WORKERS', 8))
+    # in 'flat' mode, refresh listings from the Drive Changes API after first crawl
+    DRIVE_INCREMENTAL_REFRESH = os.environ.get('DRIVE_INCREMENTAL_REFRESH', '1') == '1'
+    DRIVE_REFRESH_MINUTES = float(os.environ.get('DRIVE_REFRESH_MINUTES', 5))
+    # authorized connections to Drive shared by all threads
+    DRIVE_HTTP_POOL_SIZE = int(os.environ.get('DRIVE_HTTP_POOL_SIZE', 10))
+    # local storage for listing snapshots and other cached data, kept private
+    # to the app's user since snapshots are unpickled and cached files served
+    CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'blind_challenge'))
+    SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(CACHE_DIR, 'snapshots'))
+    # API discovery documents, saved so services are built without fetching them
+    DISCOVERY_DIR = os.environ.get('DISCOVERY_DIR', os.path.join(CACHE_DIR, 'discovery'))
+    # downloaded and converted files, keyed by id, version and output type
+    DOWNLOAD_CACHE_DIR = os.environ.get('DOWNLOAD_CACHE_DIR',
+                                        os.path.join(CACHE_DIR, 'downloads'))
+    DOWNLOAD_CACHE_MAX_MB = float(os.environ.get('DOWNLOAD_CACHE_MAX_MB', 2048))  # 0 to disable
+    # bytes fetched from Drive per request when streaming downloads
+    DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+    # zip members fetched concurrently, and per-member timeout (seconds) and retries
+    ZIP_FETCH_WORKERS = int(os.environ.get('ZIP_FETCH_WORKERS', 4))
+    ZIP_MEMBER_TIMEOUT = float(os.environ.get('ZIP_MEMBER_TIMEOUT', 120))
+    ZIP_MEMBER_RETRIES = int(os.environ.get('ZIP_MEMBER_RETRIES', 2))
+    # check files against Drive, in batches, before streaming a zip not built in
+    # advance. Off by default, as the checks delay the start of the download
+    ZIP_REVALIDATE = os.environ.get('ZIP_REVALIDATE', '0') == '1'
+    # build zips of each drive and of all drives in the background after refreshes
+    PREBUILD_ZIPS = os.environ.get('PREBUILD_ZIPS', '1') == '1'
+    ZIP_DIR = os.environ.get('ZIP_DIR', os.path.join(CACHE_DIR, 'zips'))
+    # serve counters and histograms at /metrics, in Prometheus text format
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    # most files listed on the search results page
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 200))
+    # profile this fraction of requests, e.g. 0.01, and any request sending
+    # PROFILE_TOKEN in an X-Profile-Token header or ?profile= parameter
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+    # profile every drive listing refresh
+    PROFILE_REFRESHES = os.environ.get('PROFILE_REFRESHES', '0') == '1'
+    # recent profiles, listed at /admin/profiles?token=PROFILE_TOKEN
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(CACHE_DIR, 'profiles'))
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
 
 
 class DevelopmentConfig(Config):
@@ -1,12 +1,21 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
 import io
+import json
+from itertools import islice, repeat
 import logging
+import os
+import sys
+import tempfile
+import time
+import zipfile
 
-import pandas as pd
-import networkx as nx
-from googleapiclient.http import MediaIoBaseDownload
-
-from .helpers import parse_timestamp_str
+from .helpers import iter_file_chunks, parse_timestamps
+from .metrics import (DRIVE_API_REQUESTS, DRIVE_API_SECONDS, DOWNLOAD_BYTES, DOWNLOAD_SECONDS,
+                      ZIP_SECONDS, ZIP_BYTES, ZIP_MISSING)
 
 
 logger = logging.getLogger(__name__)
@@ -19,208 +28,1117 @@ MIME_MAP = {
 }
 
 
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 403 reasons that are worth retrying, unlike e.g. fileNotDownloadable
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'dailyLimitExceeded')
+
+BATCH_SIZE = 100  # most sub-requests Drive accepts per batch request
+
+FILE_FIELDS = ("kind,id,name,webViewLink,webContentLink,iconLink,"
+               "thumbnailLink,createdTime,modifiedTime,"
+               "lastModifyingUser/displayName,mimeType,trashed,md5Checksum")
+
+# columns of file tree dataframe
+LISTING_COLUMNS = ('path', 'path_show', 'id', 'title', 'mimeType', 'date_modified',
+                   'date_created', 'last_user', 'url_view', 'url_content', 'icon',
+                   'kind', 'thumb', 'md5')
+
+
+class ListingEntry:
+    """Details of one file or folder from a Drive listing.
+
+    Slotted, with repeated strings such as mime types interned, so large
+    listings stay compact. Timestamps are kept as RFC 3339 strings until
+    the listing is turned into a dataframe.
+    """
+    __slots__ = ('id', 'title', 'mimeType', 'parent_id', 'date_modified', 'date_created',
+                 'last_user', 'url_view', 'url_content', 'icon', 'kind', 'thumb', 'md5')
+
+    def __init__(self, id, title, mimeType, parent_id=None, date_modified=None,
+                 date_created=None, last_user=None, url_view=None, url_content=None,
+                 icon=None, kind=None, thumb=None, md5=None):
+        self.id = id
+        self.title = title
+        self.mimeType = mimeType
+        self.parent_id = parent_id
+        self.date_modified = date_modified
+        self.date_created = date_created
+        self.last_user = last_user
+        self.url_view = url_view
+        self.url_content = url_content
+        self.icon = icon
+        self.kind = kind
+        self.thumb = thumb
+        self.md5 = md5
+
+    @classmethod
+    def from_resource(cls, resource):
+        """Build entry from Drive API file resource."""
+        parents = resource.get('parents')
+        user = resource.get('lastModifyingUser') or {}
+        return cls(resource['id'], resource.get('name'), _intern(resource.get('mimeType')),
+                   parents[0] if parents else None, resource.get('modifiedTime'),
+                   resource.get('createdTime'), _intern(user.get('displayName')),
+                   resource.get('webViewLink'), resource.get('webContentLink'),
+                   _intern(resource.get('iconLink')), _intern(resource.get('kind')),
+                   resource.get('thumbnailLink'), resource.get('md5Checksum'))
+
+    @property
+    def is_folder(self):
+        return self.mimeType.endswith('folder')
+
+    def __repr__(self):
+        return '<ListingEntry {} {!r}>'.format(self.id, self.title)
+
+    def __reduce__(self):  # compact pickles for listing snapshots
+        return type(self), tuple(getattr(self, i) for i in self.__slots__)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
 class Folder:
-    def __init__(self, folder_id=None, drive_id=None):
+    def __init__(self, folder_id=None, drive_id=None, files=None):
         self.folder_id = folder_id
         self.drive_id = drive_id
-        self.files = []
+        self.files = []  # will hold ListingEntry for each non-folder file
         self.folders = OrderedDict()
 
-        files = get_child_files(folder_id, drive_id=drive_id)
-        if len(files):
-            for ind, file_info in files.query('~is_folder').iterrows():
-                self.files.append(file_info)
-            for ind, folder_info in files.query('is_folder').iterrows():
-                sub_title = folder_info['title']
-                sub_id = folder_info['id']
-                self.folders[sub_id] = sub_title
+        if files is None:
+            files = get_child_files(folder_id, drive_id=drive_id)
+        if files:
+            for entry in files:
+                if entry.is_folder:
+                    self.folders[entry.id] = entry.title
+                else:
+                    self.files.append(entry)
         else:
             logger.warning('Empty folder: {}'.format(folder_id))
 
 
+def get_files_service():
+    """Get Drive v3 service handle."""
+    from .admin import get_service
+    return get_service('files')
+
+
+def get_http():
+    """Get thread-safe authorized http, drawing on a shared connection pool."""
+    from .admin import get_http_pool
+    return get_http_pool()
+
+
+def execute(request):
+    """Execute API request on a pooled http connection."""
+    with record_api_call(request.methodId):
+        return request.execute(http=get_http())
+
+
+@contextmanager
+def record_api_call(method):
+    """Record latency and outcome of Drive API call made in with block.
+
+    Args:
+        method (str): API method id, e.g. 'drive.files.list'.
+    """
+    from googleapiclient.errors import HttpError
+
+    status = 'error'
+    start = time.perf_counter()
+    try:
+        yield
+        status = 'ok'
+    except HttpError as e:
+        status = str(e.resp.status)
+        raise
+    finally:
+        DRIVE_API_SECONDS.labels(method).observe(time.perf_counter() - start)
+        DRIVE_API_REQUESTS.labels(method, status).inc()
+
+
+def list_file_records(q, drive_id=None, extra_fields=None, page_size=1000):
+    """Yield file resources matching query, following nextPageToken.
+
+    Args:
+        q (str): Drive search query.
+        drive_id (str): shared drive to search.
+        extra_fields (str): comma-separated fields to request besides FILE_FIELDS.
+        page_size (int): files per page (Drive allows at most 1000).
+    """
+    file_fields = FILE_FIELDS
+    if extra_fields:
+        file_fields = ','.join([file_fields, extra_fields])
+    fields = "nextPageToken,files({})".format(file_fields)
+
+    collection = get_files_service().files()
+    page_token = None
+    while True:
+        res = execute(collection.list(q=q,
+                                      orderBy='modifiedTime desc',
+                                      pageSize=page_size,
+                                      pageToken=page_token,
+                                      driveId=drive_id,
+                                      fields=fields,
+                                      corpora='drive',
+                                      includeItemsFromAllDrives=True,
+                                      supportsAllDrives=True,
+                                      ))
+        for record in res.get('files', []):
+            yield record
+        page_token = res.get('nextPageToken')
+        if not page_token:
+            break
+
+
+def tidy_files(records):
+    """Get ListingEntry for each file resource, leaving out trashed files."""
+    return [ListingEntry.from_resource(i) for i in records if not i.get('trashed')]
+
+
 def get_child_files(folder_id, drive_id=None):
-    """Get dataframe of files in specified folder of specified drive."""
-    file_fields = ("files(kind,id,name,webViewLink,webContentLink,iconLink,"
-                   "thumbnailLink,createdTime,modifiedTime,"
-                   "lastModifyingUser/displayName,mimeType,trashed)")
-
-    from .admin import SERVICE_HANDLES
-    collection = SERVICE_HANDLES['files'].files()
-    res = collection.list(q="{!r} in parents".format(folder_id),
-                          orderBy='modifiedTime desc',
-                          pageSize=100,
-                          driveId=drive_id,
-                          fields=file_fields,
-                          corpora='drive',
-                          includeItemsFromAllDrives=True,
-                          supportsAllDrives=True,
-                          ).execute()
-    files = pd.DataFrame.from_records(res['files'])  # type: pd.DataFrame
-    if len(files):
+    """Get list of ListingEntry for files in specified folder of specified drive."""
+    files = tidy_files(list_file_records("{!r} in parents".format(folder_id),
+                                         drive_id=drive_id))
+    if files:
         logger.info("Files loaded for folder {}: {} rows total".format(folder_id, len(files)))
-        # files.lastModifyingUser = files.lastModifyingUser.apply(lambda v: v['displayName'])
-        files.createdTime = files.createdTime.apply(parse_timestamp_str)
-        files.modifiedTime = files.modifiedTime.apply(parse_timestamp_str)
-        files.rename(columns={'webViewLink': 'url_view',
-                              'webContentLink': 'url_content',
-                              'thumbnailLink': 'thumb',
-                              'iconLink': 'icon',
-                              'modifiedTime': 'date_modified',
-                              'createdTime': 'date_created',
-                              'lastModifyingUser': 'last_user',
-                              'name': 'title'
-                             }, inplace=True)
-        file_cols_show = ['title', 'date_modified', 'last_user']
-        file_cols_other = ['id', 'mimeType', 'date_created', 'url_view', 'url_content',
-                           'icon', 'kind', 'thumb', 'trashed']
-        file_columns = file_cols_show + file_cols_other
-        files = files.query('~trashed')  # ignore trashed files
-        # ignored_columns = [i for i in files.columns if i not in file_columns]
-        files = files[[i for i in file_columns if i in files.columns]].copy()
-
-        files['is_folder'] = files.mimeType.apply(lambda v: v.endswith('folder'))
     else:
         logger.warning("No files found for folder {}.".format(folder_id))
     return files
 
 
-def extract_folders(root_folder_id):
-    """Traverse directories to populate all folder objects given a root folder."""
+def get_drive_files(drive_id):
+    """Get list of ListingEntry for every file in shared drive.
+
+    Lists the whole drive in a few paginated calls instead of one call per
+    folder. Each entry's parent_id holds the first parent of the file.
+    """
+    files = tidy_files(list_file_records('trashed = false', drive_id=drive_id,
+                                         extra_fields='parents'))
+    if files:
+        logger.info("Files loaded for drive {}: {} rows total".format(drive_id, len(files)))
+    else:
+        logger.warning("No files found for drive {}.".format(drive_id))
+    return files
+
+
+def extract_folders(root_folder_id, max_workers=1):
+    """Traverse directories to populate all folder objects given a root folder.
+
+    Args:
+        root_folder_id (str): shared drive id.
+        max_workers (int): number of folders to fetch concurrently.
+    """
+    if max_workers > 1:
+        return extract_folders_concurrent(root_folder_id, max_workers)
+    return traverse_folders(root_folder_id,
+                            lambda folder_id: Folder(folder_id=folder_id, drive_id=root_folder_id))
+
+
+def traverse_folders(root_folder_id, get_folder):
+    """Walk folder tree breadth first from root, getting each folder once.
+
+    Used by both crawl modes: get_folder either lists the folder through the
+    API or looks its files up in a whole-drive listing.
+
+    Args:
+        root_folder_id (str): shared drive id.
+        get_folder (callable): takes a folder id and returns its Folder.
+    Returns:
+        folder_dict: {folder id: Folder}, with the root under 'root'.
+        title_dict: {folder id: title}.
+    """
     # via https://stackoverflow.com/questions/28584470/iterating-over-a-growing-set-in-python
     folder_dict = {}  # will hold {id: Folder}
-    title_dict = {}  # will hold titles for folder ids
-
-    root = Folder(folder_id=root_folder_id, drive_id=root_folder_id)
-    folder_dict['root'] = root
-    title_dict['root'] = 'root'
-    for i, title in root.folders.items():
-        title_dict[i] = title
-
-    seen_ids = set(root.folders)  # sub-folder ids
-    active_ids = set(root.folders)
-
-    i = 0
-    while active_ids:
-        i += 1
-        next_active = set()
-        for subfolder_id in active_ids:
-            subfolder = Folder(folder_id=subfolder_id, drive_id=root_folder_id)
-            folder_dict[subfolder_id] = subfolder
-            for new_sub_id in subfolder.folders:
-                title_dict[new_sub_id] = subfolder.folders[new_sub_id]
-                if new_sub_id not in seen_ids:
-                    seen_ids.add(new_sub_id)
-                    next_active.add(new_sub_id)
-        active_ids = next_active
+    title_dict = {'root': 'root'}  # will hold titles for folder ids
+    seen_ids = set()  # sub-folder ids
+    active = {'root': root_folder_id}  # {folder_dict key: folder id} of next level
+
+    while active:
+        next_active = {}
+        for key, folder_id in active.items():
+            folder = get_folder(folder_id)
+            folder_dict[key] = folder
+            for sub_id, sub_title in folder.folders.items():
+                title_dict[sub_id] = sub_title
+                if sub_id not in seen_ids:
+                    seen_ids.add(sub_id)
+                    next_active[sub_id] = sub_id
+        active = next_active
+    return folder_dict, title_dict
+
+
+def extract_folders_concurrent(root_folder_id, max_workers):
+    """Traverse directories on a pool of worker threads.
+
+    Each sub-folder is queued as soon as its parent has been listed, so up to
+    max_workers folder listings are in flight at once regardless of tree
+    shape. Gives the same output as the serial traversal.
+    """
+    folder_dict = {}  # will hold {id: Folder}
+    title_dict = {'root': 'root'}  # will hold titles for folder ids
+    seen_ids = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(Folder, folder_id=root_folder_id,
+                                   drive_id=root_folder_id): 'root'}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder_key = pending.pop(future)
+                folder = future.result()
+                folder_dict[folder_key] = folder
+                for sub_id, sub_title in folder.folders.items():
+                    title_dict[sub_id] = sub_title
+                    if sub_id not in seen_ids:
+                        seen_ids.add(sub_id)
+                        future = executor.submit(Folder, folder_id=sub_id,
+                                                 drive_id=root_folder_id)
+                        pending[future] = sub_id
     return folder_dict, title_dict
 
 
-def file_tree_to_df(root_folder_id, root_title=None):
-    """Build dataframe containing all files in directory tree."""
+def extract_folders_flat(root_folder_id):
+    """Populate all folder objects from a single whole-drive listing.
+
+    Gives the same output as extract_folders, but the hierarchy is built
+    locally from parent ids. Files not reachable from the root are ignored.
+    """
+    files = get_drive_files(root_folder_id)
+    return listing_to_folders(files, root_folder_id)
+
+
+def listing_to_folders(files, root_folder_id):
+    """Build folder objects from whole-drive listing of ListingEntry."""
+    children = {}  # will hold {parent_id: [ListingEntry]}
+    for entry in files:
+        children.setdefault(entry.parent_id, []).append(entry)
+    empty = []
+    return traverse_folders(
+        root_folder_id, lambda folder_id: Folder(folder_id=folder_id, drive_id=root_folder_id,
+                                                 files=children.get(folder_id, empty)))
+
+
+def file_tree_to_df(root_folder_id, root_title=None, flat=False, max_workers=1):
+    """Build dataframe containing all files in directory tree.
+
+    Args:
+        root_folder_id (str): shared drive id.
+        root_title (str): title for top-level directory in paths.
+        flat (bool): list whole drive at once rather than crawling each folder.
+        max_workers (int): concurrent folder fetches when crawling each folder.
+    """
     # GET FOLDER OBJECTS
-    folder_dict, title_dict = extract_folders(root_folder_id)
+    if flat:
+        folder_dict, title_dict = extract_folders_flat(root_folder_id)
+    else:
+        folder_dict, title_dict = extract_folders(root_folder_id, max_workers=max_workers)
+    return folders_to_df(folder_dict, title_dict, root_title)
+
+
+def listing_to_df(files, root_folder_id, root_title=None):
+    """Build file tree dataframe from whole-drive listing, without API calls.
+
+    Args:
+        files (list): listing from get_drive_files.
+        root_folder_id (str): shared drive id.
+        root_title (str): title for top-level directory in paths.
+    """
+    folder_dict, title_dict = listing_to_folders(files, root_folder_id)
+    return folders_to_df(folder_dict, title_dict, root_title)
+
+
+def folders_to_df(folder_dict, title_dict, root_title=None):
+    """Build dataframe containing all files from extracted folder objects."""
+    import pandas as pd
+
     if root_title is None:
         root_title = 'ROOT'
     title_dict['root'] = root_title
+    paths = resolve_folder_paths(folder_dict, title_dict, root_title)
 
-    # BUILD GRAPH FROM FOLDER > SUB-FOLDER RELATIONSHIPS
-    edges = []
-    for this_id in folder_dict:
-        new_edges = [(this_id, key) for key in folder_dict[this_id].folders]
-        edges.extend(new_edges)
-    graph = nx.DiGraph()
-    graph.add_edges_from(edges)
-
-    # BUILD DATAFRAME
-    # if graph.number_of_nodes:
-    df_list = []
+    # BUILD DATAFRAME, column by column, with one path string per folder
+    columns = OrderedDict((i, []) for i in LISTING_COLUMNS)
     for folder_id in folder_dict:
-        if folder_id == 'root':
-            node_path_str, node_path_str_sm = root_title, root_title
-        else:
-            node_ids = nx.algorithms.shortest_paths.generic.shortest_path(graph, 'root', folder_id)
-            node_titles = [title_dict[i] for i in node_ids]
-            node_path_str = ' > '.join(node_titles)
-            # Get shortened path for display (skip top directory name)
-            if len(node_titles) > 1:
-                node_path_str_sm = ' > '.join(node_titles[1:])
-            else:
-                node_path_str_sm = root_title
         files = folder_dict[folder_id].files
-        if files:
-            df = pd.DataFrame.from_records(files)
-            df.insert(0, 'path', node_path_str)
-            df['path_show'] = node_path_str_sm
-            df_list.append(df)
-    if df_list:
-        df = pd.concat(df_list, axis=0, ignore_index=True, sort=True)
-        df = df[['path'] + [i for i in df.columns if i != 'path']]
-    else:
-        df = pd.DataFrame()
-    return df
+        if not files:
+            continue
+        if folder_id not in paths:
+            logger.warning('Skipping {} files in folder {}, which is not reachable '
+                           'from the root.'.format(len(files), folder_id))
+            continue
+        node_path_str, node_path_str_sm = paths[folder_id]
+        columns['path'].extend([node_path_str] * len(files))
+        columns['path_show'].extend([node_path_str_sm] * len(files))
+        for field in LISTING_COLUMNS[2:]:
+            columns[field].extend([getattr(entry, field) for entry in files])
+    if not columns['id']:
+        return pd.DataFrame()
+    for field in ('date_modified', 'date_created'):
+        columns[field] = parse_timestamps(columns[field])
+    return pd.DataFrame(columns)
+
+
+def resolve_folder_paths(folder_dict, title_dict, root_title):
+    """Get full and display paths of folders, in one traversal from the root.
+
+    Each folder's path extends its parent's, so paths are built in time
+    linear in the number of folders. Folders reached more than once (e.g.
+    through a cycle) keep the first, shortest, path; folders not reachable
+    from 'root' are left out.
+
+    Args:
+        folder_dict (dict): {folder_id: Folder}, with 'root' for the root.
+        title_dict (dict): {folder_id: title}.
+        root_title (str): title for top-level directory in paths.
+    Returns:
+        dict: {folder_id: (path, path_show)}, where path_show skips the top
+            directory name.
+    """
+    paths = {'root': (root_title, root_title)}
+    queue = deque(['root'])
+    while queue:
+        parent_id = queue.popleft()
+        folder = folder_dict.get(parent_id)
+        if folder is None:
+            continue
+        parent_path, parent_path_show = paths[parent_id]
+        for sub_id in folder.folders:
+            if sub_id in paths:
+                continue
+            title = title_dict[sub_id]
+            path_show = title if parent_id == 'root' else parent_path_show + ' > ' + title
+            paths[sub_id] = (parent_path + ' > ' + title, path_show)
+            queue.append(sub_id)
+    return paths
+
+
+def get_start_page_token(drive_id):
+    """Get token for listing future changes to shared drive."""
+    request = get_files_service().changes().getStartPageToken(
+        driveId=drive_id, supportsAllDrives=True)
+    return execute(request)['startPageToken']
+
+
+def get_changes(drive_id, page_token, page_size=1000):
+    """Get changes to shared drive files since page token.
+
+    Returns:
+        changes (list): change resources, oldest first, with file resources
+            including parents.
+        new_token (str): start page token for the next call.
+    """
+    fields = ("nextPageToken,newStartPageToken,"
+              "changes(changeType,fileId,removed,file({},parents))".format(FILE_FIELDS))
+    collection = get_files_service().changes()
+    changes = []
+    while True:
+        res = execute(collection.list(pageToken=page_token,
+                                      pageSize=page_size,
+                                      driveId=drive_id,
+                                      fields=fields,
+                                      includeRemoved=True,
+                                      includeItemsFromAllDrives=True,
+                                      supportsAllDrives=True,
+                                      ))
+        changes.extend(res.get('changes', []))
+        if 'newStartPageToken' in res:
+            return changes, res['newStartPageToken']
+        page_token = res['nextPageToken']
+
+
+def apply_changes(files, changes):
+    """Apply file changes to whole-drive listing.
+
+    Added, renamed and moved files replace their previous rows; removed and
+    trashed files are dropped.
+
+    Args:
+        files (list): listing from get_drive_files.
+        changes (list): change resources from get_changes.
+    Returns:
+        files (list): updated listing.
+    """
+    changed_ids = set()
+    updated = OrderedDict()  # will hold {id: latest file resource}
+    for change in changes:
+        if change.get('changeType', 'file') != 'file':
+            continue
+        file_id = change['fileId']
+        record = change.get('file')
+        changed_ids.add(file_id)
+        updated.pop(file_id, None)
+        if not change.get('removed') and record and not record.get('trashed'):
+            updated[file_id] = record
+    logger.info("Applying {} changes: {} files added or updated".format(
+        len(changed_ids), len(updated)))
+    if not changed_ids:
+        return files
+
+    files = [entry for entry in files if entry.id not in changed_ids]
+    files.extend(tidy_files(updated.values()))
+    return files
+
+
+def batch_get_files(file_ids, fields='id,name,mimeType,modifiedTime,md5Checksum,trashed',
+                    batch_size=BATCH_SIZE, retries=3, backoff=1.0):
+    """Get file resources for many files, batch_size per HTTP call.
+
+    Lookups that fail with rate limit or server errors are retried in later
+    batches, waiting backoff seconds before the first retry and doubling
+    after each.
+
+    Args:
+        file_ids (iterable): ids of files to look up.
+        fields (str): comma-separated file fields to get.
+        batch_size (int): lookups per batch request, at most BATCH_SIZE.
+        retries (int): extra attempts for failed lookups.
+        backoff (float): seconds before first retry.
+    Returns:
+        dict: {file_id: file resource}, or None for files that don't exist.
+            Files whose lookups failed on every attempt are left out.
+    """
+    from googleapiclient.errors import HttpError
+
+    service = get_files_service()
+    results = {}
+    failed = []
+    pending = list(OrderedDict.fromkeys(file_ids))
+
+    def on_response(file_id, response, exception):
+        status = str(exception.resp.status) if isinstance(exception, HttpError) else 'error'
+        DRIVE_API_REQUESTS.labels('drive.files.get', 'ok' if exception is None else status).inc()
+        if exception is None:
+            results[file_id] = response
+        elif isinstance(exception, HttpError) and exception.resp.status == 404:
+            results[file_id] = None
+        elif isinstance(exception, HttpError) and (exception.resp.status in (403, 429)
+                                                   or exception.resp.status >= 500):
+            failed.append(file_id)
+        else:
+            logger.error('Lookup failed for file {}: {!r}'.format(file_id, exception))
+
+    for attempt in range(retries + 1):
+        if attempt:
+            logger.warning('Retrying {} failed file lookups.'.format(len(pending)))
+            time.sleep(backoff * 2 ** (attempt - 1))
+        failed = []
+        for start in range(0, len(pending), batch_size):
+            batch = service.new_batch_http_request(callback=on_response)
+            for file_id in pending[start:start + batch_size]:
+                batch.add(service.files().get(fileId=file_id, fields=fields,
+                                              supportsAllDrives=True),
+                          request_id=file_id)
+            try:
+                with record_api_call('batch'):
+                    batch.execute(http=get_http())
+            except HttpError as e:
+                logger.warning('Batch request failed: {!r}'.format(e))
+                failed.extend(pending[start:start + batch_size])
+        pending = failed
+        if not pending:
+            break
+    if pending:
+        logger.error('Giving up on lookups of {} files.'.format(len(pending)))
+    return results
+
+
+class MediaStream:
+    """Iterator over content chunks of a media download request.
+
+    Only one chunk is held in memory at a time. The first chunk is fetched
+    on creation, so `size` is known before any content is passed on, if
+    Drive reports it. Exports are sent by Drive in a single chunk.
+
+    Args:
+        request (googleapiclient.http.HttpRequest): media request.
+        chunk_size (int): bytes per ranged request.
+    """
+
+    def __init__(self, request, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        from googleapiclient.http import MediaIoBaseDownload
+
+        self._buffer = io.BytesIO()
+        self._downloader = MediaIoBaseDownload(self._buffer, request, chunksize=chunk_size)
+        self._method = request.methodId  # get_media shares its id with metadata gets
+        if self._method == 'drive.files.get' and 'alt=media' in request.uri:
+            self._method = 'drive.files.get_media'
+        self._done = False
+        self.size = None
+        self._first_chunk = self._next_chunk()
+
+    def _next_chunk(self):
+        with record_api_call(self._method):
+            status, self._done = self._downloader.next_chunk()
+        self.size = status.total_size
+        chunk = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return chunk
+
+    def __iter__(self):
+        chunk, self._first_chunk = self._first_chunk, None
+        yield chunk
+        while not self._done:
+            yield self._next_chunk()
 
 
 def download_raw_file(file_id):
     """Get binary data for file."""
-    from .admin import SERVICE_HANDLES
-    request = SERVICE_HANDLES['files'].files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        # print("Download %d%%." % int(status.progress() * 100))
-    return fh
+    request = get_files_service().files().get_media(fileId=file_id)
+    request.http = get_http()
+    return _download_request(request, file_id)
 
 
-def download_file(file_id, title, mime_orig):
+def file_version(file_info):
+    """Get string identifying content version of file in listing.
+
+    Args:
+        file_info: listing row with 'date_modified' and optional 'md5'.
+    """
+    md5 = file_info.get('md5')
+    if not isinstance(md5, str):
+        md5 = ''
+    return '{}:{}'.format(file_info.get('date_modified'), md5)
+
+
+def listing_fingerprint(files_df):
+    """Get hash of file ids, titles, folder paths and versions in listing.
+
+    Changes whenever a file is added, removed, renamed, moved or modified.
+    """
+    digest = hashlib.sha1()
+    if len(files_df):
+        md5s = files_df['md5'] if 'md5' in files_df.columns else [None] * len(files_df)
+        paths = files_df['path'] if 'path' in files_df.columns else [None] * len(files_df)
+        rows = sorted(zip(files_df.id, files_df.title, paths,
+                          files_df.date_modified.astype(str), md5s))
+        for file_id, title, path, modified, md5 in rows:
+            if not isinstance(md5, str):
+                md5 = ''
+            digest.update('{}\0{}\0{}\0{}:{}\n'.format(
+                file_id, title, path, modified, md5).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class FileRecord(namedtuple('FileRecord', ['id', 'title', 'mimeType', 'date_modified',
+                                             'md5', 'path', 'drive'])):
+    """Listing details of one file, as needed for downloads and zips."""
+    __slots__ = ()
+
+    def get(self, field, default=None):
+        """Get field value, like listing rows."""
+        return getattr(self, field, default)
+
+
+def iter_records(files_df, drive=None):
+    """Yield FileRecord for each row of listing, in listing order.
+
+    Args:
+        files_df (pd.DataFrame): file listing.
+        drive (str): name of drive holding listing.
+    """
+    if not len(files_df):
+        return
+    cols = [files_df[i] if i in files_df.columns else repeat(None)
+            for i in FileRecord._fields[:-1]]
+    for values in zip(*cols):
+        yield FileRecord(*values, drive)
+
+
+def index_files(files_df, drive=None):
+    """Get {file_id: FileRecord} index of listing, for constant-time lookups."""
+    return {r.id: r for r in iter_records(files_df, drive)}
+
+
+def refresh_records(files, batch_size=BATCH_SIZE):
+    """Check listed files against Drive, in batches, before using them.
+
+    Args:
+        files: listing DataFrame or iterable of FileRecord.
+        batch_size (int): lookups per batch request.
+    Returns:
+        list: FileRecord for each file, updated where the file has been
+            renamed or modified since listing. Removed and trashed files are
+            left out. Files that couldn't be checked are kept as listed.
+    """
+    records = list(_as_records(files))
+    resources = batch_get_files([r.id for r in records], batch_size=batch_size)
+    kept = []  # will hold (record, current resource or None if unchecked)
+    for r in records:
+        resource = resources.get(r.id, False)
+        if resource is None or (resource and resource.get('trashed')):
+            logger.info('Leaving out removed file {}.'.format(r.title))
+        else:
+            kept.append((r, resource or None))
+    checked = [resource for r, resource in kept if resource]
+    modified = iter(parse_timestamps([i.get('modifiedTime') for i in checked]))
+    return [r._replace(title=resource['name'], mimeType=resource['mimeType'],
+                       date_modified=next(modified), md5=resource.get('md5Checksum'))
+            if resource else r
+            for r, resource in kept]
+
+
+def _file_request(file_id, title, mime_orig):
+    """Get media request, output filename and output mime type for file."""
+    files_service = get_files_service()
+
+    if mime_orig in MIME_MAP:
+        mime_out, extension = MIME_MAP[mime_orig]
+        request = files_service.files().export_media(fileId=file_id,
+                                                     mimeType=mime_out)
+        filename = ''.join([title, extension])
+    else:  # direct download
+        request = files_service.files().get_media(fileId=file_id)
+        filename = title
+        mime_out = mime_orig
+    request.http = get_http()  # used by MediaIoBaseDownload
+    return request, filename, mime_out
+
+
+def is_permanent_error(exception):
+    """Whether a failed download would fail again if retried.
+
+    Client errors such as a file type Drive can't download or export, or an
+    export over the size limit, are permanent. Server errors, rate limits,
+    timeouts and connection errors are not.
+    """
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    if status < 400 or status >= 500 or status == 429:
+        return False
+    try:
+        errors = json.loads(exception.content.decode('utf-8'))['error'].get('errors', [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        errors = []
+    return not any(e.get('reason') in RATE_LIMIT_REASONS for e in errors)
+
+
+def download_file(file_id, title, mime_orig, version=None, cache=None):
     """Download Drive file, converting format if necessary.
 
     Args:
         file_id (str): Drive file id.
         title (str): Drive file title.
         mime_orig (str): Mime type of Drive file.
+        version (str): content version from file_version, for caching.
+        cache (FileCache): cache for downloaded content. Only used if
+            version is given.
     Returns:
         fh (io.BytesIO): file stream
         filename: file and extension of output file
         mime_out: output mime type
     """
-    from .admin import SERVICE_HANDLES
-    file_id = file_id
+    request, filename, mime_out = _file_request(file_id, title, mime_orig)
 
-    if mime_orig in MIME_MAP:
-        mime_out, extension = MIME_MAP[mime_orig]
-        request = SERVICE_HANDLES['files'].files().export_media(fileId=file_id,
-                                                                mimeType=mime_out)
-        filename = ''.join([title, extension])
-    else:  # direct download
-        request = SERVICE_HANDLES['files'].files().get_media(fileId=file_id)
-        filename = title
-        mime_out = mime_orig
+    if cache is None or version is None:
+        return _download_request(request, title), filename, mime_out
+
+    key = cache.make_key(file_id, version, mime_out)
+    with cache.lock(key):
+        start = time.perf_counter()
+        data = cache.get(key)
+        if data is None:
+            fh = _download_request(request, title)
+            cache.put(key, fh.getvalue())
+        else:
+            logger.info('Loaded {} from cache'.format(title))
+            fh = io.BytesIO(data)
+            _record_download('cache', len(data), start)
+    return fh, filename, mime_out
+
+
+def stream_file(file_id, title, mime_orig, version=None, cache=None,
+                chunk_size=DOWNLOAD_CHUNK_SIZE, lock_timeout=60, share_download=True):
+    """Stream Drive file in chunks, converting format if necessary.
+
+    Content comes from the cache if present. Otherwise it is downloaded from
+    Drive by a background thread that fills the cache, however fast the
+    chunks are read. Concurrent requests for the same file version stream
+    from that one download (see FileCache.stream).
+
+    Args:
+        file_id (str): Drive file id.
+        title (str): Drive file title.
+        mime_orig (str): Mime type of Drive file.
+        version (str): content version from file_version, for caching.
+        cache (FileCache): cache for downloaded content. Only used if
+            version is given.
+        chunk_size (int): maximum bytes per chunk.
+        lock_timeout (float): most seconds to wait for another request
+            starting the download. After that the file is streamed from
+            Drive without caching it.
+        share_download (bool): whether to join a download already filling
+            the cache. With False, only complete cache entries are used and
+            the file is otherwise streamed from Drive without caching, e.g.
+            to retry after an attempt that seems stuck.
+    Returns:
+        chunks (iterator): file content as bytes chunks
+        filename: file and extension of output file
+        mime_out: output mime type
+        size (int): content length in bytes, or None if unknown
+    """
+    request, filename, mime_out = _file_request(file_id, title, mime_orig)
+    start = time.perf_counter()
+
+    def download():
+        media = MediaStream(request, chunk_size=chunk_size)
+        return iter(media), media.size
+
+    if cache is not None and version is not None:
+        key = cache.make_key(file_id, version, mime_out)
+        if share_download:
+            streamed = cache.stream(key, download, chunk_size, timeout=lock_timeout)
+            if streamed is None:
+                logger.warning('Timed out waiting for cache of {}'.format(title))
+        else:
+            f = cache.open(key)
+            streamed = None if f is None else (
+                iter_file_chunks(f, chunk_size), os.fstat(f.fileno()).st_size, False)
+        if streamed is not None:
+            chunks, size, downloaded = streamed
+            if not downloaded:
+                logger.info('Streaming {} from cache'.format(title))
+            chunks = _measure_chunks(chunks, 'drive' if downloaded else 'cache', start)
+            return chunks, filename, mime_out, size
+
+    chunks, size = download()
+    return _measure_chunks(chunks, 'drive', start), filename, mime_out, size
+
+
+def _measure_chunks(chunks, source, start):
+    """Pass on chunks, recording bytes streamed and time taken once done."""
+    nbytes = 0
+    try:
+        for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+    finally:
+        _record_download(source, nbytes, start)
+
+
+def _record_download(source, nbytes, start):
+    DOWNLOAD_BYTES.labels(source).inc(nbytes)
+    DOWNLOAD_SECONDS.labels(source).observe(time.perf_counter() - start)
+
+
+def _download_request(request, title):
+    """Get media request content as io.BytesIO."""
+    start = time.perf_counter()
     fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        # print("Download %d%%." % int(status.progress() * 100))
+    for chunk in MediaStream(request):
+        fh.write(chunk)
     logger.info('Downloaded {}'.format(title))
-    return fh, filename, mime_out
+    _record_download('drive', fh.tell(), start)
+    return fh
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Unseekable output for zipfile, emptied as the archive is streamed.
+
+    zipfile writes data descriptors after each member instead of seeking
+    back to fill in local headers when its output can't seek.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    def pop(self):
+        """Get and clear bytes written since last call."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_folder_zip(files_df, cache=None, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                    compression=zipfile.ZIP_DEFLATED, workers=1, member_timeout=None,
+                    member_retries=0, spool_size=DOWNLOAD_CHUNK_SIZE, base_path=None,
+                    missing=None):
+    """Stream zip archive of files as each member is downloaded.
+
+    Local headers and member data are yielded as they are produced and the
+    central directory at the end. ZIP64 extensions are used where sizes
+    need them. Members are named by their folder path below base_path, so
+    the archive keeps the folder structure, with ' (2)' etc. added to names
+    that would otherwise clash.
+
+    With one worker, each member is streamed straight from Drive, so memory
+    use stays around one chunk. With more, members are prefetched on a
+    worker pool (see prefetch_members) and written in listing order. Members
+    that can't be fetched are skipped and listed in MISSING_FILES.txt. A
+    member whose download fails part way through is kept as far as it got,
+    since its start has already been streamed, and listed as incomplete.
+
+    Args:
+        files_df (pd.DataFrame): listing of files to include, or iterable
+            of FileRecord.
+        cache (FileCache): cache for downloaded content.
+        chunk_size (int): maximum bytes per download chunk.
+        compression (int): zipfile compression method.
+        workers (int): number of members fetched concurrently.
+        member_timeout (float): seconds to wait for each member fetch
+            attempt when prefetching, or None to wait indefinitely.
+        member_retries (int): extra attempts for each member when prefetching.
+        spool_size (int): bytes of each prefetched member kept in memory
+            before spilling to a temporary file.
+        base_path (str): listing path of zipped folder, e.g. 'Drive > Reports',
+            that member names are relative to. With None, names start with
+            the drive name.
+        missing (list): list to add (MISSING_FILES.txt line, exception)
+            pairs to, for callers that need to know why the archive is
+            incomplete.
+    Yields:
+        bytes: zip file content.
+    """
+    records = _as_records(files_df)
+    if workers > 1:
+        members = prefetch_members(records, cache=cache, chunk_size=chunk_size,
+                                   workers=workers, timeout=member_timeout,
+                                   retries=member_retries, spool_size=spool_size)
+    else:
+        members = ((r, _open_member(r, cache, chunk_size)) for r in records)
+
+    output = ZipStreamBuffer()
+    names = set()  # lowercase member names, as some file systems ignore case
+    if missing is None:
+        missing = []
+    start = time.perf_counter()
+    try:
+        with zipfile.ZipFile(output, 'w', compression=compression, allowZip64=True) as zf:
+            for r, member in members:
+                if isinstance(member, Exception):
+                    logger.error('Leaving {} out of zip: {!r}'.format(r.title, member))
+                    missing.append(('{} > {}: {!r}'.format(r.get('path'), r.title, member),
+                                    member))
+                    continue
+                logger.info('Adding to zip: {}'.format(r.title))
+                chunks, filename, mime_out, size = member
+                name = _unique_name(_member_name(r.get('path'), filename, base_path), names)
+                zinfo = zipfile.ZipInfo(name,
+                                        date_time=_zip_date_time(r.get('date_modified')))
+                zinfo.compress_type = compression
+                force_zip64 = size is None or size > zipfile.ZIP64_LIMIT
+                if size is not None:
+                    zinfo.file_size = size
+                with zf.open(zinfo, 'w', force_zip64=force_zip64) as member_file:
+                    try:
+                        for chunk in chunks:
+                            member_file.write(chunk)
+                            data = output.pop()
+                            if data:
+                                yield data
+                    except Exception as e:
+                        logger.error('Zip member {} cut short: {!r}'.format(r.title, e))
+                        missing.append(('{} > {}: incomplete, {!r}'.format(
+                            r.get('path'), r.title, e), e))
+                yield output.pop()
+            if missing:
+                zf.writestr(_unique_name('MISSING_FILES.txt', names),
+                            ''.join(line + '\n' for line, _ in missing))
+        yield output.pop()
+    finally:
+        ZIP_SECONDS.observe(time.perf_counter() - start)
+        ZIP_BYTES.inc(output.tell())
+        ZIP_MISSING.inc(len(missing))
+
+
+def _member_name(path, filename, base_path=None):
+    """Get zip member name from listing path of file's folder and filename."""
+    folders = path.split(' > ') if isinstance(path, str) and path else []
+    if base_path:
+        base = base_path.split(' > ')
+        if folders[:len(base)] == base:
+            folders = folders[len(base):]
+    return '/'.join(i.replace('/', '_') for i in folders + [filename])
+
+
+def _unique_name(name, names):
+    """Get name, or name with ' (2)' etc. before its extension if already used.
+
+    Args:
+        name (str): member name.
+        names (set): lowercase names already used, to add the new one to.
+    """
+    unique = name
+    stem, extension = os.path.splitext(name)
+    count = 1
+    while unique.lower() in names:
+        count += 1
+        unique = '{} ({}){}'.format(stem, count, extension)
+    names.add(unique.lower())
+    return unique
+
+
+def _open_member(r, cache, chunk_size):
+    """Start streaming file record as from stream_file, or get the exception raised."""
+    try:
+        return stream_file(r.id, r.title, r.mimeType, version=file_version(r),
+                           cache=cache, chunk_size=chunk_size)
+    except Exception as e:
+        return e
+
 
+def prefetch_members(files_df, cache=None, chunk_size=DOWNLOAD_CHUNK_SIZE, workers=4,
+                     timeout=None, retries=0, spool_size=DOWNLOAD_CHUNK_SIZE):
+    """Download files on a worker pool, yielding them in listing order.
 
-def download_folder_zip(files_df):
+    At most `workers` files are fetched ahead of the one being consumed,
+    each held in a temporary file that stays in memory up to spool_size
+    bytes, which bounds memory use. A fetch attempt that fails or takes
+    longer than timeout seconds is retried up to `retries` times; the slow
+    attempt is left to finish in the background. Closing the generator
+    cancels queued fetches, and the spooled files of attempts that are never
+    consumed are closed when they finish.
+
+    Yields:
+        (record, member): FileRecord for listing row, and either (chunks,
+            filename, mime_out, size) as from stream_file, or the exception
+            that stopped the file being fetched.
+    """
+    rows = iter(_as_records(files_df))
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(r, retry=False):
+        # retries don't join a cache fill, which may be the stuck first attempt
+        return executor.submit(_spool_file, r, cache, chunk_size, spool_size,
+                               share_download=not retry)
+
+    try:
+        window = deque((r, [submit(r)]) for r in islice(rows, workers))
+        while window:
+            r, attempts = window.popleft()
+            next_row = next(rows, None)
+            if next_row is not None:
+                window.append((next_row, [submit(next_row)]))
+            yield r, _wait_for_member(r, attempts, submit, timeout, retries)
+    finally:
+        for _, attempts in window:
+            _discard_attempts(attempts)
+        # cancel_futures needs Python 3.9, so queued attempts are cancelled above
+        executor.shutdown(wait=False)
+
+
+def _as_records(files):
+    """Get FileRecord iterable from listing DataFrame or iterable of records."""
+    import pandas as pd
+
+    if isinstance(files, pd.DataFrame):
+        return iter_records(files)
+    return files
+
+
+def _wait_for_member(r, attempts, submit, timeout, retries):
+    """Get result of first successful fetch attempt, submitting retries.
+
+    Attempts still running when this returns are discarded.
+    """
+    try:
+        while True:
+            done, not_done = wait(attempts, timeout=timeout, return_when=FIRST_COMPLETED)
+            if done:
+                future = done.pop()
+                attempts.remove(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+                if attempts and not retries:  # an earlier attempt may yet succeed
+                    continue
+            else:
+                error = TimeoutError('No response after {} s'.format(timeout))
+            if not retries:
+                return error
+            retries -= 1
+            logger.warning('Retrying download of {}: {!r}'.format(r.title, error))
+            attempts.append(submit(r, retry=True))
+    finally:
+        _discard_attempts(attempts)
+
+
+def _discard_attempts(attempts):
+    """Cancel fetch attempts, closing spools of any that already started."""
+    for future in attempts:
+        future.cancel()
+        future.add_done_callback(_close_attempt)
+
+
+def _close_attempt(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    future.result()[0].close()
+
+
+class _SpooledChunks:
+    """Iterator over chunks of a spooled file, which close() discards."""
+
+    def __init__(self, spool, chunk_size):
+        self._spool = spool
+        self._chunks = iter_file_chunks(spool, chunk_size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+        self._spool.close()
+
+
+def _spool_file(r, cache, chunk_size, spool_size, share_download=True):
+    """Download file from listing row to a spooled temporary file."""
+    chunks, filename, mime_out, size = stream_file(
+        r.id, r.title, r.mimeType, version=file_version(r), cache=cache,
+        chunk_size=chunk_size, share_download=share_download)
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+        size = spool.tell()
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return _SpooledChunks(spool, chunk_size), filename, mime_out, size
+
+
+def _zip_date_time(timestamp):
+    """Get zip member date_time tuple, defaulting to now for missing dates."""
+    import pandas as pd
+
+    if timestamp is None or pd.isnull(timestamp):
+        timestamp = datetime.now()
+    return max(timestamp.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def download_folder_zip(files_df, cache=None):
     """Combine all files into single zip file stream to send to user.
 
+    Args:
+        files_df (pd.DataFrame): listing of files to include.
+        cache (FileCache): cache for downloaded content.
     Returns:
         zipped_file (io.BytesIO): zip file buffer.
     """
-    import io
-    import zipfile
-
     zipped_file = io.BytesIO()
-    with zipfile.ZipFile(zipped_file, 'w') as f:
-        for ind, r in files_df.iterrows():
-            logger.info('Adding to zip: {}'.format(r.title))
-            fh, filename, mime_out = download_file(r.id, r.title, r.mimeType)
-            f.writestr(filename, fh.getvalue())
-
+    for data in iter_folder_zip(files_df, cache=cache):
+        zipped_file.write(data)
     return zipped_file
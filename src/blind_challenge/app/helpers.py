@@ -1,6 +1,8 @@
+from contextlib import contextmanager
 from datetime import timezone
-
-import pandas as pd
+import os
+import pickle
+import tempfile
 
 
 def get_utc_naive(dt):
@@ -10,8 +12,122 @@ def get_utc_naive(dt):
 
 def parse_timestamp_str(time):
     """Get naive datetime in UTC."""
+    import pandas as pd
+
     # manual version
     # datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
     timestamp = pd.to_datetime(time).replace(tzinfo=timezone.utc)
     # dt = timestamp.to_pydatetime().replace(tzinfo=timezone.utc)
     return get_utc_naive(timestamp)
+
+
+def parse_timestamps(values):
+    """Get naive UTC datetimes for many timestamp strings in one call.
+
+    Strings in the RFC 3339 UTC form Drive returns, e.g.
+    '2019-01-01T12:00:00.000Z', are parsed by numpy directly. Anything else,
+    e.g. times with UTC offsets, goes through the slower pandas parser.
+
+    Args:
+        values (list-like): timestamp strings, or None for missing times.
+    Returns:
+        pd.DatetimeIndex: naive UTC timestamps, NaT where missing.
+    """
+    import numpy as np
+    import pandas as pd
+
+    values = list(values)
+    if all(v is None or (isinstance(v, str) and v.endswith('Z')) for v in values):
+        try:
+            return pd.DatetimeIndex(np.array([v[:-1] if v is not None else 'NaT' for v in values],
+                                             dtype='datetime64[us]'))
+        except ValueError:
+            pass
+    return pd.to_datetime(values, utc=True).tz_convert(None)
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """Open temporary file that replaces path once closed without error.
+
+    Readers, including those in other processes, see either the old file or
+    the complete new one, never a partial write.
+    """
+    dir_name = os.path.dirname(path) or '.'
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def iter_file_chunks(f, chunk_size):
+    """Yield chunks of open file, closing it at the end."""
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def save_pickle(obj, path):
+    """Pickle object to path atomically."""
+    with atomic_write(path) as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_pickle(path):
+    """Load pickled object from path, or None if there is no file.
+
+    Unpickling can run arbitrary code, so the file must belong to the current
+    user and must not be writable by anyone else.
+
+    Raises:
+        PermissionError: if the file could have been written by another user.
+    """
+    try:
+        with open(path, 'rb') as f:
+            check_private(os.fstat(f.fileno()), path)
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def make_private_dir(path):
+    """Create directory readable and writable by the current user only.
+
+    An existing directory is accepted if it belongs to the current user, and
+    access by other users is removed from it.
+
+    Raises:
+        PermissionError: if the directory belongs to another user.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.stat(path)
+    check_private(stat, path, check_mode=False)
+    if stat.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+def check_private(stat, path, check_mode=True):
+    """Raise PermissionError unless stat is of a file owned by the current user.
+
+    Args:
+        stat (os.stat_result): status of file or directory.
+        path (str): path, for the error message.
+        check_mode (bool): also refuse files other users can write to.
+    """
+    if not hasattr(os, 'getuid'):  # no ownership to check, e.g. on Windows
+        return
+    if stat.st_uid != os.getuid():
+        raise PermissionError('{} belongs to another user.'.format(path))
+    if check_mode and stat.st_mode & 0o022:
+        raise PermissionError('{} is writable by other users.'.format(path))
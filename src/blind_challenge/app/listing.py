@@ -0,0 +1,72 @@
+from collections import ChainMap, OrderedDict
+from datetime import datetime
+from types import MappingProxyType
+
+from .search import search
+
+
+class ListingSnapshot:
+    """Read-only view of every drive listing at one point in time.
+
+    A new snapshot is made whenever a drive refresh finishes and published
+    by replacing the reference to the old one, so a request holding a
+    snapshot sees the same consistent listing throughout.
+
+    Args:
+        version (int): number increasing with each published snapshot.
+        tables (OrderedDict): {drive_name: files DataFrame}.
+        cols_show (OrderedDict): {column: heading} of columns to display.
+        indexes (dict): {drive_name: {file_id: FileRecord}}.
+        search_indexes (dict): {drive_name: SearchIndex}.
+    """
+    __slots__ = ('version', 'created', 'tables', 'cols_show', 'indexes', 'file_index',
+                 'search_indexes')
+
+    def __init__(self, version, tables, cols_show, indexes, search_indexes=None):
+        self.version = version
+        self.created = datetime.utcnow()
+        self.tables = MappingProxyType(OrderedDict(tables))
+        self.cols_show = cols_show
+        self.indexes = MappingProxyType(dict(indexes))
+        self.search_indexes = MappingProxyType(dict(search_indexes or {}))
+        # lookups by file id search each drive's index in turn
+        self.file_index = ChainMap(*self.indexes.values())
+
+    def __repr__(self):
+        return '<ListingSnapshot v{} {}>'.format(self.version, list(self.tables))
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError('ListingSnapshot is read-only.')
+        super().__setattr__(name, value)
+
+    def replace(self, drive_tables, version=None):
+        """Get next snapshot, with listings of drive_tables updated.
+
+        Args:
+            drive_tables (dict): {drive_name: DriveTable} of refreshed tables.
+            version (int): version of new snapshot, by default one more
+                than this one.
+        """
+        tables = OrderedDict(self.tables)
+        indexes = dict(self.indexes)
+        search_indexes = dict(self.search_indexes)
+        cols_show = self.cols_show
+        for name, drive_table in drive_tables.items():
+            tables[name] = drive_table.current_df
+            indexes[name] = drive_table.index
+            search_indexes[name] = drive_table.search_index
+            cols_show = drive_table.cols_show
+        if version is None:
+            version = self.version + 1
+        return ListingSnapshot(version, tables, cols_show, indexes, search_indexes)
+
+    def search(self, query, limit=100, **filters):
+        """Get files best matching query across all drives, as SearchHit list.
+
+        See SearchIndex.search for filters.
+        """
+        return search(self.search_indexes.values(), query, limit=limit, **filters)
+
+
+EMPTY_LISTING = ListingSnapshot(0, OrderedDict(), None, {})
@@ -0,0 +1,260 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+
+class Registry:
+    """Collection of metrics, rendered together in Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError('Metric {} is already registered.'.format(metric.name))
+            self._metrics.append(metric)
+
+    def render(self):
+        """Get text exposition of all metrics, for a Prometheus scrape."""
+        lines = []
+        for metric in list(self._metrics):
+            lines.append('# HELP {} {}'.format(metric.name, _escape(metric.documentation)))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(metric.name, suffix, _format_labels(labels),
+                                                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """Metric with a child per combination of label values.
+
+    Children are made on first use and kept, so label values should come
+    from a small set, e.g. API method names, never file names.
+
+    Args:
+        name (str): metric name.
+        documentation (str): help text.
+        labelnames (list): names of labels.
+        registry (Registry): registry to add metric to, or None.
+    """
+    kind = None  # subclasses will override
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # will hold {label values: child}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Get child for label values, given in labelnames order."""
+        values = tuple(str(i) for i in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} takes labels {}.'.format(self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Yield (name suffix, labels dict, value) for each sample."""
+        for values, child in sorted(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                yield suffix, dict(labels, **extra), value
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield '', {}, self.value
+
+
+class Counter(Metric):
+    """Count that only goes up, e.g. of requests or bytes sent."""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """Increment metric without labels."""
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Get value by calling function at each scrape instead."""
+        self.function = function
+
+    def samples(self):
+        yield '', {}, self.function() if self.function else self.value
+
+
+class Gauge(Metric):
+    """Value that can go up and down, e.g. a size or timestamp."""
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        """Set metric without labels."""
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last for values above all bounds
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe seconds taken by the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + [math.inf], counts):
+            cumulative += count
+            yield '_bucket', {'le': _format_value(bound)}, cumulative
+        yield '_sum', {}, total
+        yield '_count', {}, cumulative
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies, in cumulative buckets.
+
+    Args:
+        buckets (list): upper bounds of buckets, ascending.
+        **kwargs: passed to Metric.
+    """
+    kind = 'histogram'
+    default_buckets = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None, **kwargs):
+        self.buckets = sorted(buckets or self.default_buckets)
+        super().__init__(name, documentation, labelnames, **kwargs)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """Observe value for metric without labels."""
+        self.labels().observe(value)
+
+    def time(self):
+        """Observe seconds taken by with block, for metric without labels."""
+        return self.labels().time()
+
+
+def _escape(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(str(v)).replace('"', r'\"'))
+                          for k, v in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# Drive API
+DRIVE_API_REQUESTS = Counter(
+    'blind_drive_api_requests_total',
+    'Drive API requests, by API method and outcome (ok, HTTP error status or error).',
+    ['method', 'status'])
+DRIVE_API_SECONDS = Histogram(
+    'blind_drive_api_request_seconds',
+    'Latency of Drive API requests, by API method.', ['method'])
+
+# listings
+REFRESH_SECONDS = Histogram(
+    'blind_drive_refresh_seconds',
+    'Duration of drive listing refreshes, by drive and kind (crawl or changes).',
+    ['drive', 'kind'])
+REFRESH_FAILURES = Counter(
+    'blind_drive_refresh_failures_total', 'Failed drive listing refreshes.', ['drive'])
+LAST_REFRESH = Gauge(
+    'blind_drive_last_refresh_timestamp_seconds',
+    'Unix time of the data in the latest drive listing.', ['drive'])
+LISTING_FILES = Gauge(
+    'blind_drive_listing_files', 'Files in the latest drive listing.', ['drive'])
+
+# downloads and zips
+DOWNLOAD_BYTES = Counter(
+    'blind_download_bytes_total',
+    'Bytes of file content sent or zipped, by source (drive or cache).', ['source'])
+DOWNLOAD_SECONDS = Histogram(
+    'blind_download_seconds',
+    'Time to stream file content, by source (drive or cache).', ['source'])
+CACHE_LOOKUPS = Counter(
+    'blind_cache_lookups_total', 'Download cache lookups, by result (hit or miss).',
+    ['result'])
+ZIP_SECONDS = Histogram(
+    'blind_zip_build_seconds', 'Time to produce zip archives, streamed or prebuilt.')
+ZIP_BYTES = Counter('blind_zip_bytes_total', 'Bytes of zip archives produced.')
+ZIP_MISSING = Counter(
+    'blind_zip_missing_files_total', 'Files left out of zips after failed downloads.')
+ZIP_RESPONSES = Counter(
+    'blind_zip_responses_total', 'Zip downloads, by source (prebuilt or streamed).',
+    ['source'])
+
+# app requests
+HTTP_REQUESTS = Counter(
+    'blind_http_requests_total', 'App requests, by endpoint and status.',
+    ['endpoint', 'status'])
+HTTP_SECONDS = Histogram(
+    'blind_http_request_seconds',
+    'Time to start of response, by endpoint. Streamed bodies are not included.',
+    ['endpoint'])
@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import glob
+import io
+import json
+import logging
+import marshal
+import os
+import pstats
+import re
+import threading
+import time
+
+from .helpers import atomic_write, make_private_dir
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileStore:
+    """Recent cProfile profiles of requests and refreshes, kept on disk.
+
+    Each profile is saved as a pstats file, which snakeviz, gprof2dot,
+    flameprof and pstats itself can read, next to a JSON file describing it.
+    Only the newest profiles are kept.
+
+    Args:
+        directory (str): directory for profiles, created if missing.
+        keep (int): number of profiles to keep.
+    """
+
+    def __init__(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        make_private_dir(directory)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, kind, label):
+        """Profile code in with block, in the current thread only, and save it.
+
+        Args:
+            kind (str): what is profiled, e.g. 'request' or 'refresh'.
+            label (str): description, e.g. request path or drive name.
+        """
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler is active
+            logger.warning('Skipping profile of {} {}: profiler busy.'.format(kind, label))
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.save(profiler, kind, label, time.perf_counter() - start)
+
+    def save(self, profiler, kind, label, seconds):
+        """Save stopped profiler's stats, then remove old profiles.
+
+        Returns:
+            str: name of saved profile.
+        """
+        with self._lock:
+            self._count += 1
+            count = self._count
+        created = datetime.utcnow()
+        name = '{:%Y%m%d-%H%M%S}-{}-{}-{}'.format(
+            created, os.getpid(), count, re.sub(r'[^\w-]', '_', kind))
+        profiler.create_stats()
+        with atomic_write(self._path(name, '.prof')) as f:
+            marshal.dump(profiler.stats, f)
+        info = {'name': name, 'kind': kind, 'label': label, 'seconds': seconds,
+                'created': created.isoformat()}
+        with atomic_write(self._path(name, '.json'), mode='w') as f:
+            json.dump(info, f)
+        logger.info('Saved profile of {} {} ({:.3f} s): {}'.format(kind, label, seconds, name))
+        self._remove_old()
+        return name
+
+    def _path(self, name, extension):
+        return os.path.join(self.directory, name + extension)
+
+    def prof_path(self, name):
+        """Get path of pstats file for named profile, or None if it doesn't exist."""
+        path = self._path(os.path.basename(name), '.prof')
+        return path if os.path.exists(path) else None
+
+    def recent(self):
+        """Get info dict of each saved profile, newest first."""
+        profiles = []
+        for path in sorted(glob.glob(self._path('*', '.json')), reverse=True):
+            try:
+                with open(path) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):  # removed or being replaced
+                continue
+        return sorted(profiles, key=lambda i: i['created'], reverse=True)
+
+    def summary(self, name, sort='cumulative', limit=40):
+        """Get text table of the most expensive functions in named profile.
+
+        Returns:
+            str: pstats listing, or None if there is no such profile.
+        """
+        path = self.prof_path(name)
+        if path is None:
+            return None
+        out = io.StringIO()
+        stats = pstats.Stats(path, stream=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def _remove_old(self):
+        for info in self.recent()[self.keep:]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(self._path(info['name'], extension))
+                except FileNotFoundError:
+                    pass
+
+
+@contextmanager
+def maybe_profile(store, kind, label):
+    """Profile with block if store is given, else just run it."""
+    if store is None:
+        yield
+        return
+    with store.profile(kind, label):
+        yield
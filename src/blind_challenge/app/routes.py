@@ -1,14 +1,118 @@
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+import hmac
+import os
+import random
+import threading
+import time
+import unicodedata
+from urllib.parse import quote
 
-import pandas as pd
-from flask import redirect, url_for, render_template, flash, abort, g, send_file
+from flask import (redirect, url_for, render_template, flash, abort, g, send_file,
+                   request, session, make_response, Response)
 from flask_login import login_required, login_user, logout_user
+from werkzeug.http import generate_etag
 
-from . import app, update_drive_listing
+from . import (app, update_drive_listing, DOWNLOAD_CACHE, ZIP_STORE, ALL_FILES_SCOPE,
+               PROFILE_STORE)
 from .forms import LoginForm
+from .metrics import REGISTRY, HTTP_REQUESTS, HTTP_SECONDS, ZIP_RESPONSES
 from .models import User
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """Count request and record time taken to produce response."""
+    endpoint = request.endpoint or 'none'
+    HTTP_REQUESTS.labels(endpoint, response.status_code).inc()
+    start = g.get('request_start')
+    if start is not None:
+        HTTP_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """App metrics, for Prometheus to scrape."""
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.before_request
+def start_request_profile():
+    """Profile request if sampled or asked for with PROFILE_TOKEN."""
+    if PROFILE_STORE is None or not wants_profile():
+        return
+    g.profile = ExitStack()
+    g.profile.enter_context(PROFILE_STORE.profile(
+        'request', '{} {}'.format(request.method, request.path)))
+
+
+@app.after_request
+def finish_request_profile(response):
+    stop_request_profile()
+    return response
+
+
+@app.teardown_request
+def stop_request_profile(exception=None):
+    """Stop and save request profile, if not already done when the response was made."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.close()
+
+
+def wants_profile():
+    token = app.config['PROFILE_TOKEN']
+    if token and any(hmac.compare_digest(token, i) for i in
+                     (request.headers.get('X-Profile-Token'), request.args.get('profile'))
+                     if i):
+        return True
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def profiles_allowed():
+    """Check session may see profiles, granting access on ?token=PROFILE_TOKEN."""
+    token = app.config['PROFILE_TOKEN']
+    if PROFILE_STORE is None or not token:
+        return False
+    if hmac.compare_digest(token, request.args.get('token', '')):
+        session['profile_admin'] = True
+    return session.get('profile_admin', False)
+
+
+@app.route('/admin/profiles')
+@login_required
+def list_profiles():
+    """Recent profiles, with the most expensive functions of the one named."""
+    if not profiles_allowed():
+        abort(404)
+    name = request.args.get('name')
+    summary = PROFILE_STORE.summary(name) if name else None
+    return render_template('profiles.html', title='Profiles', profiles=PROFILE_STORE.recent(),
+                           name=name, summary=summary)
+
+
+@app.route('/admin/profiles/<name>.prof')
+@login_required
+def download_profile(name):
+    if not profiles_allowed():
+        abort(404)
+    path = PROFILE_STORE.prof_path(name)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     attachment_filename='{}.prof'.format(name))
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
@@ -31,7 +135,7 @@ def logout():
 @app.route('/reload')
 def load_members_list():
     if True:
-        update_drive_listing()
+        update_drive_listing(use_snapshot=False)
         flash('File listing updated.', 'message')
         return render_template('reload.html')
     else:
@@ -41,37 +145,175 @@ def load_members_list():
 @app.route('/')
 @login_required
 def browse():
+    listing = g.listing
+    if session.get('_flashes'):  # page with one-off messages, so don't cache
+        return render_browse(listing)
+    page = get_browse_page(listing)
+    response = make_response(page.body)
+    response.set_etag(page.etag)
+    response.last_modified = listing.created
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # revalidate, getting 304 if unchanged
+    return response.make_conditional(request)
+
+
+def render_browse(listing):
     title = app.config['CHALLENGE_NAME']
-    return render_template("browse.html", title=title, df_dict=g.tables,
-                           cols_show=g.cols_show)
+    return render_template("browse.html", title=title, df_dict=listing.tables,
+                           cols_show=listing.cols_show)
+
+
+@app.route('/search')
+@login_required
+def search_files():
+    """Files matching words in their titles or folders, with optional filters."""
+    from .search import MIME_FILTERS
+
+    query = request.args.get('q', '').strip()
+    mime = request.args.get('mime') or None
+    error = None
+    try:
+        after = parse_date(request.args.get('after'))
+        before = parse_date(request.args.get('before'))
+    except ValueError:
+        after = before = None
+        error = 'Dates should be given as YYYY-MM-DD.'
+    hits = None
+    if error is None and (query or mime or after or before):
+        hits = g.listing.search(query, mime=mime, modified_after=after,
+                                modified_before=before + timedelta(days=1) if before else None,
+                                limit=app.config['SEARCH_MAX_RESULTS'])
+    return render_template('search.html', title=app.config['CHALLENGE_NAME'], query=query,
+                           mime=mime, after=request.args.get('after', ''),
+                           before=request.args.get('before', ''), mime_filters=MIME_FILTERS,
+                           hits=hits, error=error)
+
+
+def parse_date(text):
+    """Get datetime from YYYY-MM-DD string, or None if text is empty."""
+    if not text:
+        return None
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+BrowsePage = namedtuple('BrowsePage', ['key', 'body', 'etag'])
+_browse_page = BrowsePage(None, None, None)
+_browse_page_lock = threading.Lock()
+
+
+def get_browse_page(listing):
+    """Get browse page for listing, rendering it only once per snapshot version."""
+    global _browse_page
+    key = (listing.version, listing.created, request.script_root)
+    page = _browse_page
+    if page.key == key:
+        return page
+    with _browse_page_lock:
+        if _browse_page.key != key:
+            body = render_browse(listing).encode('utf-8')
+            _browse_page = BrowsePage(key, body, generate_etag(body))
+        return _browse_page
+
+
+def set_attachment(response, filename):
+    """Set Content-Disposition header for download of named file."""
+    try:
+        filename.encode('latin-1')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode()
+        names = {'filename': simple, 'filename*': "UTF-8''{}".format(quote(filename))}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
 
 
 @app.route('/download/<file_id>')
 def download(file_id):
-    from .drive import download_file
+    from .drive import stream_file, file_version
 
-    files = pd.concat(g.tables.values(), axis=0, ignore_index=True, sort=False)
-    try:
-        file_info = files[files.id == file_id].iloc[0]
-    except IndexError:
+    file_info = g.file_index.get(file_id)
+    if file_info is None:
         flash('File not found', 'error')
-        return redirect(url_for('download'))
+        return redirect(url_for('browse'))
     title = file_info.title
     mime_orig = file_info.mimeType
-    fh, filename, mime_out = download_file(file_id, title=title, mime_orig=mime_orig)
-    fh.seek(0)
-    return send_file(fh, mimetype=mime_out,
-                     as_attachment=True, attachment_filename=filename)
+    chunks, filename, mime_out, size = stream_file(
+        file_id, title=title, mime_orig=mime_orig, version=file_version(file_info),
+        cache=DOWNLOAD_CACHE, chunk_size=app.config['DOWNLOAD_CHUNK_SIZE'])
+    response = Response(chunks, mimetype=mime_out, direct_passthrough=True)
+    if size is not None:
+        response.content_length = size
+    return set_attachment(response, filename)
 
 
 @app.route('/build_zip')
 def get_folder_zip():
-    from .drive import download_folder_zip
+    import pandas as pd
 
     files = pd.concat(g.tables.values(), axis=0, ignore_index=True, sort=False)
-    zipped_file = download_folder_zip(files)
+    return zip_response(files, ALL_FILES_SCOPE, 'files')
+
+
+@app.route('/build_zip/<drive_name>')
+def get_drive_zip(drive_name):
+    """Zip of one drive, or of a folder and its sub-folders if path is given."""
+    if drive_name not in g.tables:
+        abort(404)
+    files = g.tables[drive_name]
+    path = request.args.get('path')
+    if not path:
+        return zip_response(files, drive_name, 'files_{}'.format(drive_name),
+                            base_path=drive_name)
+    if len(files):
+        in_folder = (files.path == path) | files.path.str.startswith(path + ' > ')
+        files = files[in_folder]
+    if not len(files):
+        abort(404)
+    folder_name = files.path_show.iloc[0] if files.path.iloc[0] == path else path
+    return zip_response(files, None, 'files_{}'.format(folder_name.replace(' > ', '_')),
+                        base_path=path)
+
+
+@app.route('/build_zip/selected', methods=['POST'])
+def get_selected_zip():
+    """Zip of files whose ids are posted as file_id values."""
+    file_ids = OrderedDict.fromkeys(request.form.getlist('file_id'))
+    files = [g.file_index[i] for i in file_ids if i in g.file_index]
+    if not files:
+        flash('No files selected', 'error')
+        return redirect(url_for('browse'))
+    return zip_response(files, None, 'files_selected')
+
+
+def zip_response(files, scope, name_prefix, base_path=None):
+    """Send prebuilt zip for scope if there is one, else stream zip of files.
+
+    Args:
+        files: listing DataFrame or FileRecord list of files to include.
+        scope (str): ZIP_STORE scope for these files, or None if not prebuilt.
+        name_prefix (str): start of download filename.
+        base_path (str): listing path that member names are relative to.
+    """
+    from .drive import iter_folder_zip, refresh_records
+
+    zip_path = ZIP_STORE.latest(scope) if ZIP_STORE and scope else None
+    if zip_path is not None:
+        built = datetime.utcfromtimestamp(os.path.getmtime(zip_path))
+        out_name = '{}_{}.zip'.format(name_prefix, built.strftime('%Y-%m-%d_%H:%M:%SZ'))
+        ZIP_RESPONSES.labels('prebuilt').inc()
+        return send_file(zip_path, mimetype='application/zip', conditional=True,
+                         as_attachment=True, attachment_filename=out_name)
+
+    # no prebuilt zip, so stream one
+    ZIP_RESPONSES.labels('streamed').inc()
+    if app.config['ZIP_REVALIDATE']:
+        files = refresh_records(files)  # listing may be minutes old
+    chunks = iter_folder_zip(files, cache=DOWNLOAD_CACHE, base_path=base_path,
+                             chunk_size=app.config['DOWNLOAD_CHUNK_SIZE'],
+                             workers=app.config['ZIP_FETCH_WORKERS'],
+                             member_timeout=app.config['ZIP_MEMBER_TIMEOUT'],
+                             member_retries=app.config['ZIP_MEMBER_RETRIES'])
     time_str = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%SZ')
-    out_name = 'files_{}.zip'.format(time_str)
-    zipped_file.seek(0)
-    return send_file(zipped_file, mimetype='application/zip',
-                     as_attachment=True, attachment_filename=out_name)
+    out_name = '{}_{}.zip'.format(name_prefix, time_str)
+    response = Response(chunks, mimetype='application/zip', direct_passthrough=True)
+    return set_attachment(response, out_name)
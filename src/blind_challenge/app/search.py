@@ -0,0 +1,223 @@
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, namedtuple
+import heapq
+from itertools import repeat
+import re
+import unicodedata
+
+
+SearchHit = namedtuple('SearchHit', ['score', 'id', 'title', 'path_show', 'mimeType',
+                                     'date_modified', 'drive'])
+
+# mime type filters offered on the search page, matched as prefixes
+MIME_FILTERS = OrderedDict([
+    ('PDF', 'application/pdf'),
+    ('Google Docs', 'application/vnd.google-apps.document'),
+    ('Google Sheets', 'application/vnd.google-apps.spreadsheet'),
+    ('Google Slides', 'application/vnd.google-apps.presentation'),
+    ('Images', 'image/'),
+    ('Text', 'text/'),
+])
+
+FIELD_WEIGHTS = (('title', 3.0), ('path', 1.0))  # score of a whole-token match
+PREFIX_WEIGHT = 0.5  # fraction of field weight for a match on the start of a token
+
+_DOC_COLUMNS = ('id', 'title', 'path_show', 'mimeType', 'date_modified')
+_token_re = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Get lowercase word tokens of text, with accents removed."""
+    if not isinstance(text, str) or not text:
+        return []
+    text = unicodedata.normalize('NFKD', text.lower())
+    return _token_re.findall(''.join(c for c in text if not unicodedata.combining(c)))
+
+
+class SearchIndex:
+    """Inverted index over titles and folder paths of one drive listing.
+
+    Every token of each file's title and path_show is indexed, and query
+    terms also match the start of tokens, so 'rep' finds 'report'. Queries
+    only touch the postings of their terms, never the whole listing.
+
+    Args:
+        files_df (pd.DataFrame): drive listing.
+        drive (str): name of drive, given in search hits.
+        previous (SearchIndex): index of the drive's previous listing. Only
+            files added, removed, renamed or moved since then are tokenized,
+            and only the postings of their tokens are replaced. The previous
+            index is left unchanged, as it may still be in use.
+    """
+
+    def __init__(self, files_df, drive=None, previous=None):
+        self.drive = drive
+        self.docs = {}  # will hold {file_id: (id, title, path_show, mimeType, date_modified)}
+        self._tokens = {}  # will hold {file_id: (title, path_show, title tokens, path tokens)}
+        old_tokens = previous._tokens if previous is not None else {}
+        # will hold {field: ({token: file ids removed}, {token: file ids added})}
+        changes = {field: (defaultdict(set), defaultdict(list)) for field, weight in FIELD_WEIGHTS}
+        cols = [files_df[i].tolist() if i in files_df.columns else repeat(None)
+                for i in _DOC_COLUMNS] if len(files_df) else []
+        for doc in zip(*cols):
+            file_id, title, path_show = doc[:3]
+            self.docs[file_id] = doc
+            tokens = old_tokens.get(file_id)
+            if tokens is None or tokens[:2] != (title, path_show):
+                new_tokens = (title, path_show, frozenset(tokenize(title)),
+                              frozenset(tokenize(path_show)))
+                _add_changes(changes, file_id, tokens, new_tokens)
+                tokens = new_tokens
+            self._tokens[file_id] = tokens
+        for file_id in old_tokens.keys() - self._tokens.keys():
+            _add_changes(changes, file_id, old_tokens[file_id], None)
+        self._postings = {}  # will hold {field: {token: tuple of file ids}}
+        self._vocab = {}  # will hold {field: sorted tokens}
+        for field, weight in FIELD_WEIGHTS:
+            postings, vocab = ((previous._postings[field], previous._vocab[field])
+                               if previous is not None else ({}, []))
+            self._postings[field], self._vocab[field] = _update_postings(
+                postings, vocab, *changes[field])
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _term_scores(self, term):
+        """Get {file_id: score} of files matching query term in any field."""
+        scores = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS:
+            postings, vocab = self._postings[field], self._vocab[field]
+            best = {}
+            for file_id in postings.get(term, ()):
+                best[file_id] = weight
+            for i in range(bisect_left(vocab, term), len(vocab)):
+                token = vocab[i]
+                if not token.startswith(term):
+                    break
+                if token != term:
+                    for file_id in postings[token]:
+                        best.setdefault(file_id, weight * PREFIX_WEIGHT)
+            for file_id, score in best.items():
+                scores[file_id] += score
+        return scores
+
+    def search(self, query, mime=None, modified_after=None, modified_before=None, limit=100):
+        """Get best matching files, highest score first.
+
+        Files must match every query term. With no terms, all files passing
+        the filters match equally.
+
+        Args:
+            query (str): words to find in titles and folder paths.
+            mime (str): mime type, or its start (e.g. 'image/'), to keep.
+            modified_after (datetime): keep files modified at or after this.
+            modified_before (datetime): keep files modified before this.
+            limit (int): most hits to return.
+        Returns:
+            list: SearchHit for each file found.
+        """
+        terms = list(OrderedDict.fromkeys(tokenize(query)))
+        if terms:
+            scores = None
+            for term in terms:
+                term_scores = self._term_scores(term)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {i: s + term_scores[i] for i, s in scores.items()
+                              if i in term_scores}
+                if not scores:
+                    return []
+        else:
+            scores = dict.fromkeys(self.docs, 0.0)
+        hits = (SearchHit(score, *self.docs[file_id], self.drive)
+                for file_id, score in scores.items()
+                if _passes(self.docs[file_id], mime, modified_after, modified_before))
+        return heapq.nsmallest(limit, hits, key=_rank)
+
+
+def _add_changes(changes, file_id, old_tokens, new_tokens):
+    """Record tokens a file loses and gains in each field.
+
+    Args:
+        changes (dict): {field: ({token: file ids removed}, {token: file ids
+            added})} to add to.
+        file_id (str): id of file.
+        old_tokens (tuple): file's previous _tokens entry, or None if added.
+        new_tokens (tuple): file's new _tokens entry, or None if removed.
+    """
+    for i, (field, weight) in enumerate(FIELD_WEIGHTS, 2):
+        removed, added = changes[field]
+        old = old_tokens[i] if old_tokens is not None else frozenset()
+        new = new_tokens[i] if new_tokens is not None else frozenset()
+        for token in old - new:
+            removed[token].add(file_id)
+        for token in new - old:
+            added[token].append(file_id)
+
+
+def _update_postings(postings, vocab, removed, added):
+    """Get copies of postings and sorted vocabulary with changes applied.
+
+    Only postings of changed tokens are rebuilt; the rest are shared with
+    the originals, which are left unchanged.
+
+    Args:
+        postings (dict): {token: tuple of file ids}.
+        vocab (list): sorted tokens of postings.
+        removed (dict): {token: set of file ids no longer having token}.
+        added (dict): {token: list of file ids newly having token}.
+    """
+    if not removed and not added:
+        return postings, vocab
+    postings = dict(postings)
+    new_tokens, gone_tokens = [], set()
+    for token in removed.keys() | added.keys():
+        old_ids = postings.get(token)
+        ids = old_ids or ()
+        if token in removed:
+            gone = removed[token]
+            ids = tuple(i for i in ids if i not in gone)
+        if token in added:
+            ids += tuple(added[token])
+        if ids:
+            postings[token] = ids
+            if old_ids is None:
+                new_tokens.append(token)
+        elif old_ids is not None:
+            del postings[token]
+            gone_tokens.add(token)
+    if new_tokens or gone_tokens:
+        vocab = [i for i in vocab if i not in gone_tokens] + new_tokens
+        vocab.sort()  # quick, as only the new tokens at the end are out of order
+    return postings, vocab
+
+
+def _passes(doc, mime, modified_after, modified_before):
+    if mime and not (doc[3] or '').startswith(mime):
+        return False
+    modified = doc[4]
+    if modified_after is not None and not modified >= modified_after:
+        return False
+    if modified_before is not None and not modified < modified_before:
+        return False
+    return True
+
+
+def _rank(hit):
+    return -hit.score, hit.title or '', hit.path_show or '', hit.id or ''
+
+
+def search(indexes, query, limit=100, **filters):
+    """Get best matching files across several drive indexes.
+
+    Args:
+        indexes (iterable): SearchIndex of each drive.
+        query (str): words to find in titles and folder paths.
+        limit (int): most hits to return.
+        **filters: passed to SearchIndex.search.
+    """
+    hits = []
+    for index in indexes:
+        hits.extend(index.search(query, limit=limit, **filters))
+    return heapq.nsmallest(limit, hits, key=_rank)
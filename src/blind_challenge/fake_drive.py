@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Google Drive v3 API, for tests and benchmarks.
+
+FakeDrive takes the place of the httplib2 connection used by
+googleapiclient, answering requests from a synthetic shared drive held in
+memory. Services built on top of it behave like the real thing, so the app
+code can be exercised without Google credentials:
+
+    fake = FakeDrive.generate(depth=3, fanout=4, latency=0.01)
+    service = fake.build_service()
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import email.parser
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+DISCOVERY_PATH = os.path.join(os.path.dirname(__file__), 'drive_v3_discovery.json')
+GOOGLE_MIME_PREFIX = 'application/vnd.google-apps.'
+
+
+def _format_time(dt):
+    """Format datetime as RFC 3339 string, as Drive does."""
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(dt.microsecond // 1000)
+
+
+def _parse_file_fields(fields):
+    """Get top-level file field names from partial response fields string.
+
+    e.g. 'nextPageToken,files(id,name,lastModifyingUser/displayName)'
+    gives ['id', 'name', 'lastModifyingUser']. Returns None for all fields.
+    """
+    if not fields:
+        return None
+    match = re.search(r'files\((.*)\)', fields)
+    if not match:
+        return None
+    return [i.split('/')[0].strip() for i in match.group(1).split(',')]
+
+
+class FakeDrive:
+    """In-memory shared drive answering Drive v3 HTTP requests.
+
+    Args:
+        drive_id (str): shared drive id, also the id of the root folder.
+        latency (float): seconds to sleep before answering each request.
+
+    Attributes:
+        media_delays (dict): extra seconds to sleep before sending content,
+            by file id.
+        media_failures (dict): number of content requests to fail with a
+            server error, by file id.
+        metadata_failures (dict): number of metadata requests to fail with a
+            server error, by file id.
+    """
+    batch_limit = 100  # sub-requests allowed per batch request
+
+    def __init__(self, drive_id='fake-drive', latency=0.0):
+        self.drive_id = drive_id
+        self.latency = latency
+        self.files = OrderedDict()  # will hold {id: file resource}
+        self.changes = []  # will hold (file_id, removed) for each change
+        self.request_count = 0
+        self.media_delays = {}
+        self.media_failures = {}
+        self.metadata_failures = {}
+        self._file_count = 0
+        self._lock = threading.Lock()
+        self._clock = datetime(2019, 1, 1)
+
+    @classmethod
+    def generate(cls, depth=2, fanout=3, files_per_folder=5, file_size=1024,
+                 docs_per_folder=0, seed=0, **kwargs):
+        """Build drive with a regular folder tree.
+
+        Args:
+            depth (int): levels of folders below the root.
+            fanout (int): sub-folders per folder.
+            files_per_folder (int): files in each folder, including root.
+            file_size (int or tuple): size in bytes of each file, or
+                (min, max) range of random sizes.
+            docs_per_folder (int): Google Docs in each folder, besides files.
+                Their content is only available as exports.
+            seed (int): random seed for modification times and sizes.
+            **kwargs: passed to FakeDrive.
+        """
+        drive = cls(**kwargs)
+        rand = random.Random(seed)
+
+        def populate(parent_id, level):
+            for i in range(files_per_folder):
+                drive.add_file('file {}.pdf'.format(i), parent_id=parent_id,
+                               modified_offset=rand.randint(0, 10 ** 6),
+                               size=(file_size if isinstance(file_size, int)
+                                     else rand.randint(*file_size)))
+            for i in range(docs_per_folder):
+                drive.add_file('doc {}'.format(i), parent_id=parent_id,
+                               mime_type=GOOGLE_MIME_PREFIX + 'document',
+                               modified_offset=rand.randint(0, 10 ** 6))
+            if level < depth:
+                for i in range(fanout):
+                    sub_id = drive.add_folder('folder {}'.format(i), parent_id=parent_id)
+                    populate(sub_id, level + 1)
+
+        populate(drive.drive_id, 0)
+        return drive
+
+    @property
+    def folder_count(self):
+        """Number of folders, including the root."""
+        return 1 + sum(f['mimeType'] == FOLDER_MIME for f in self.files.values())
+
+    def add_file(self, name, parent_id=None, mime_type='application/pdf',
+                 modified_offset=0, trashed=False, size=1024):
+        """Add file resource to drive and return its id.
+
+        Args:
+            name (str): file title.
+            parent_id (str): parent folder id (defaults to drive root).
+            mime_type (str): file mime type.
+            modified_offset (int): seconds after creation of modification.
+            trashed (bool): whether file is in trash.
+            size (int): content size in bytes. Google Docs editors files
+                have no stored content, only exports.
+        """
+        with self._lock:
+            file_id = 'id{:06d}'.format(self._file_count)
+            self._file_count += 1
+            created = self._clock
+            self._clock += timedelta(seconds=1)
+            self.files[file_id] = {
+                'kind': 'drive#file',
+                'id': file_id,
+                'name': name,
+                'mimeType': mime_type,
+                'parents': [parent_id or self.drive_id],
+                'trashed': trashed,
+                'createdTime': _format_time(created),
+                'modifiedTime': _format_time(created + timedelta(seconds=modified_offset)),
+                'lastModifyingUser': {'displayName': 'Fake User'},
+                'iconLink': 'https://example.com/icon/{}'.format(mime_type),
+                'webViewLink': 'https://example.com/view/{}'.format(file_id),
+            }
+            if not mime_type.startswith(GOOGLE_MIME_PREFIX):
+                content = self.content(file_id, size)
+                self.files[file_id].update({
+                    'size': str(size),
+                    'md5Checksum': hashlib.md5(content).hexdigest(),
+                })
+            self.changes.append((file_id, False))
+        return file_id
+
+    def add_folder(self, name, parent_id=None):
+        """Add folder to drive and return its id."""
+        return self.add_file(name, parent_id=parent_id, mime_type=FOLDER_MIME)
+
+    @staticmethod
+    def content(file_id, size):
+        """Get synthetic file content."""
+        block = '{} '.format(file_id).encode('utf-8')
+        return (block * (size // len(block) + 1))[:size]
+
+    def export_content(self, file_id, mime_type):
+        """Get synthetic content of Google Docs editors file export."""
+        record = self.files[file_id]
+        return 'Export of {} as {}, modified {}.'.format(
+            file_id, mime_type, record['modifiedTime']).encode('utf-8')
+
+    def update_file(self, file_id, **fields):
+        """Update file resource fields and record change.
+
+        e.g. update_file(file_id, name='new name', parents=[folder_id])
+        """
+        with self._lock:
+            record = self.files[file_id]
+            record.update(fields)
+            self._clock += timedelta(seconds=1)
+            record['modifiedTime'] = _format_time(self._clock)
+            self.changes.append((file_id, False))
+
+    def trash_file(self, file_id):
+        """Move file to trash."""
+        self.update_file(file_id, trashed=True)
+
+    def delete_file(self, file_id):
+        """Remove file permanently."""
+        with self._lock:
+            del self.files[file_id]
+            self.changes.append((file_id, True))
+
+    def build_service(self):
+        """Build googleapiclient Drive v3 service that talks to this drive.
+
+        Uses the discovery document saved next to this module, so no request
+        is made for it, with any google-api-python-client version.
+        """
+        from googleapiclient.discovery import build_from_document
+        with open(DISCOVERY_PATH) as f:
+            return build_from_document(f.read(), http=self)
+
+    # httplib2.Http interface
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=5, connection_type=None):
+        """Answer API request, like httplib2.Http.request."""
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(uri)
+        if url.path.endswith('/batch/drive/v3') and method == 'POST':
+            return self._batch(body, headers or {})
+        return self._dispatch(url, method, headers)
+
+    def _dispatch(self, url, method, headers):
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.endswith('/drive/v3/files') and method == 'GET':
+            return self._list_files(params)
+        media_match = (re.search(r'/drive/v3/files/([^/]+)$', url.path)
+                       if params.get('alt') == 'media' else None)
+        export_match = re.search(r'/drive/v3/files/([^/]+)/export$', url.path)
+        if media_match or export_match:
+            file_id = (media_match or export_match).group(1)
+            time.sleep(self.media_delays.get(file_id, 0))
+            with self._lock:
+                failures = self.media_failures.get(file_id, 0)
+                self.media_failures[file_id] = max(failures - 1, 0)
+            if failures:
+                return self._response(500, {'error': {'code': 500, 'message': 'Backend Error'}})
+            if media_match:
+                return self._get_media(file_id, headers or {})
+            return self._export(file_id, params['mimeType'])
+        get_match = re.search(r'/drive/v3/files/([^/]+)$', url.path)
+        if get_match and method == 'GET':
+            return self._get_file(get_match.group(1), params)
+        if url.path.endswith('/drive/v3/changes/startPageToken'):
+            return self._response(200, {'startPageToken': str(len(self.changes))})
+        if url.path.endswith('/drive/v3/changes'):
+            return self._list_changes(params)
+        return self._response(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+    # endpoints
+
+    def _list_files(self, params):
+        files = list(self.files.values())
+        for clause in params.get('q', '').split(' and '):
+            clause = clause.strip()
+            parent_match = re.match(r"'(.*)' in parents", clause)
+            if parent_match:
+                parent_id = parent_match.group(1)
+                files = [f for f in files if parent_id in f['parents']]
+            elif clause == 'trashed = false':
+                files = [f for f in files if not f['trashed']]
+        if params.get('orderBy') == 'modifiedTime desc':
+            files.sort(key=lambda f: f['modifiedTime'], reverse=True)
+
+        start = int(params.get('pageToken') or 0)
+        page_size = int(params.get('pageSize', 100))
+        page = files[start:start + page_size]
+        field_names = _parse_file_fields(params.get('fields'))
+        if field_names is not None:
+            page = [{k: f[k] for k in field_names if k in f} for f in page]
+        content = {'kind': 'drive#fileList', 'files': page}
+        if start + page_size < len(files):
+            content['nextPageToken'] = str(start + page_size)
+        return self._response(200, content)
+
+    def _get_file(self, file_id, params):
+        with self._lock:
+            failures = self.metadata_failures.get(file_id, 0)
+            self.metadata_failures[file_id] = max(failures - 1, 0)
+        if failures:
+            return self._response(500, {'error': {'code': 500, 'message': 'Backend Error'}})
+        record = self.files.get(file_id)
+        if record is None:
+            return self._response(404, {'error': {'code': 404, 'message': 'File not found: '
+                                                  '{}.'.format(file_id)}})
+        if params.get('fields'):
+            field_names = [i.split('/')[0].strip() for i in params['fields'].split(',')]
+            record = {k: record[k] for k in field_names if k in record}
+        return self._response(200, record)
+
+    def _batch(self, body, headers):
+        """Answer multipart/mixed batch of requests, in one response."""
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        message = email.parser.Parser().parsestr(
+            'Content-Type: {}\r\n\r\n{}'.format(headers['content-type'], body))
+        parts = message.get_payload()
+        if len(parts) > self.batch_limit:
+            return self._response(400, {'error': {'code': 400, 'message': 'Too many '
+                                                  'requests in batch.'}})
+        boundary = 'batch_fake_drive'
+        lines = []
+        for part in parts:
+            request_line = part.get_payload().split('\n', 1)[0].strip()
+            method, path, _ = request_line.split(' ')
+            resp, content = self._dispatch(urlparse(path), method, {})
+            lines += ['--' + boundary,
+                      'Content-Type: application/http',
+                      'Content-ID: <response-{}'.format(part['Content-ID'][1:]),
+                      '',
+                      'HTTP/1.1 {} {}'.format(resp.status, 'OK' if resp.status < 300 else 'Error'),
+                      'Content-Type: application/json; charset=UTF-8',
+                      '',
+                      content.decode('utf-8')]
+        lines.append('--{}--'.format(boundary))
+        resp = httplib2.Response({'status': 200, 'content-type':
+                                  'multipart/mixed; boundary={}'.format(boundary)})
+        return resp, '\r\n'.join(lines).encode('utf-8')
+
+    def _get_media(self, file_id, headers):
+        record = self.files.get(file_id)
+        if record is None:
+            return self._response(404, {'error': {'code': 404, 'message': 'Not found'}})
+        if 'size' not in record:  # Google Docs editors files, forms etc.
+            return self._response(403, {'error': {
+                'code': 403, 'message': 'Only files with binary content can be downloaded.',
+                'errors': [{'reason': 'fileNotDownloadable'}]}})
+        content = self.content(file_id, int(record['size']))
+        total = len(content)
+        range_match = re.match(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if not range_match:
+            return self._media_response(200, content, record['mimeType'])
+        start = int(range_match.group(1))
+        end = min(int(range_match.group(2) or total - 1), total - 1)
+        if start >= total:
+            resp = httplib2.Response({'status': 416,
+                                      'content-range': 'bytes */{}'.format(total)})
+            return resp, b''
+        return self._media_response(206, content[start:end + 1], record['mimeType'],
+                                    content_range='bytes {}-{}/{}'.format(start, end, total))
+
+    def _export(self, file_id, mime_type):
+        record = self.files.get(file_id)
+        if record is None or not record['mimeType'].startswith(GOOGLE_MIME_PREFIX):
+            return self._response(403, {'error': {'code': 403, 'message': 'Export only '
+                                                  'supports Docs Editors files.'}})
+        return self._media_response(200, self.export_content(file_id, mime_type), mime_type)
+
+    def _list_changes(self, params):
+        start = int(params['pageToken'])
+        page_size = int(params.get('pageSize', 100))
+        with self._lock:
+            end = min(start + page_size, len(self.changes))
+            changes = []
+            for file_id, removed in self.changes[start:end]:
+                change = {'kind': 'drive#change', 'changeType': 'file',
+                          'fileId': file_id, 'removed': removed}
+                if not removed:
+                    change['file'] = dict(self.files[file_id])
+                changes.append(change)
+            content = {'kind': 'drive#changeList', 'changes': changes}
+            if end < len(self.changes):
+                content['nextPageToken'] = str(end)
+            else:
+                content['newStartPageToken'] = str(end)
+        return self._response(200, content)
+
+    @staticmethod
+    def _media_response(status, content, mime_type, content_range=None):
+        headers = {'status': status, 'content-type': mime_type,
+                   'content-length': str(len(content))}
+        if content_range:
+            headers['content-range'] = content_range
+        return httplib2.Response(headers), content
+
+    @staticmethod
+    def _response(status, content):
+        resp = httplib2.Response({'status': status,
+                                  'content-type': 'application/json'})
+        return resp, json.dumps(content).encode('utf-8')
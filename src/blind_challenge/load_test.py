@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the app against a FakeDrive, simulating challenge participants.
+
+At challenge release many participants log in at once, open the browse page
+and start downloading files and zips. This script replays that: each
+simulated participant logs in, opens the browse page, then repeatedly waits
+a random think time and makes a request picked from a weighted mix of
+actions. Participants are threads sharing one app instance, as with a
+threaded server, each with its own test client and session. For example:
+
+    python -m blind_challenge.load_test --users 50 --duration 60 --latency 0.05
+
+The report gives throughput, latency percentiles, error rates and the
+largest resident set size seen after each kind of request, followed by the
+peak RSS of the whole run.
+"""
+
+import argparse
+from collections import OrderedDict
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from blind_challenge import __version__
+from blind_challenge.fake_drive import FakeDrive, FOLDER_MIME
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MIX = 'browse=4,download=10,zip_drive=1,zip_folder=2,zip_selected=2'
+ACTIONS = ['login', 'browse', 'download', 'zip_drive', 'zip_folder', 'zip_selected']
+
+
+def parse_mix(text):
+    """Parse weighted mix of actions.
+
+    Args:
+      text (str): comma-separated action=weight pairs,
+        e.g. 'browse=1,download=4'.
+
+    Returns:
+      OrderedDict: {action: weight} of actions with positive weights.
+    """
+    mix = OrderedDict()
+    for item in text.split(','):
+        action, _, weight = item.partition('=')
+        action = action.strip()
+        if action not in ACTIONS[1:]:
+            raise ValueError('Unknown action {!r}, expected one of {}.'.format(
+                action, ', '.join(ACTIONS[1:])))
+        if float(weight or 1) > 0:
+            mix[action] = float(weight or 1)
+    if not mix:
+        raise ValueError('Mix has no actions.')
+    return mix
+
+
+def percentile(values, q):
+    """Get q-th percentile of values, by nearest rank.
+
+    Args:
+      values (list): numbers, sorted ascending.
+      q (float): percentile, from 0 to 100.
+    """
+    if not values:
+        return float('nan')
+    rank = max(math.ceil(q / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def current_rss():
+    """Get resident set size of this process in bytes, or peak RSS if unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Get peak resident set size of this process in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class EndpointStats:
+    """Timings and outcomes of requests for one action."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.max_rss = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, ok, nbytes=0, rss=0):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.errors += not ok
+            self.bytes += nbytes
+            self.max_rss = max(self.max_rss, rss)
+
+    def summary(self, elapsed):
+        """Get dict of request count, rates, latency percentiles and memory.
+
+        Args:
+          elapsed (float): duration of run in seconds, for throughput.
+        """
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return OrderedDict([
+            ('requests', count),
+            ('errors', self.errors),
+            ('error_rate', self.errors / count if count else 0.0),
+            ('throughput', count / elapsed if elapsed else 0.0),
+            ('p50', percentile(latencies, 50)),
+            ('p95', percentile(latencies, 95)),
+            ('p99', percentile(latencies, 99)),
+            ('megabytes', self.bytes / 1e6),
+            ('max_rss_mb', self.max_rss / 1e6),
+        ])
+
+
+def serve_fake_drive(fake, drive_name, password, work_dir, prebuild_zips=True,
+                     cache_mb=512, refresh_minutes=5):
+    """Set up app to serve listing of a FakeDrive, behind the login page.
+
+    Drive API calls are answered by fake, and the download cache and
+    prebuilt zips are kept under work_dir.
+
+    Args:
+      fake (FakeDrive): drive to serve.
+      drive_name (str): name shown for the drive.
+      password (str): shared password for logging in.
+      work_dir (str): directory for cached downloads and zips.
+      prebuild_zips (bool): whether to build zips in the background.
+      cache_mb (float): download cache size, or 0 for none.
+      refresh_minutes (float): minutes after which listing is refreshed.
+
+    Returns:
+      :obj:`flask.Flask`: the app.
+    """
+    import blind_challenge.app as app_module
+    from blind_challenge.app import app, drive, routes
+    from blind_challenge.app.admin import DriveTable
+    from blind_challenge.app.archive import ZipStore
+    from blind_challenge.app.cache import FileCache
+
+    service = fake.build_service()
+    drive.get_files_service = lambda: service
+    drive.get_http = lambda: fake
+
+    app.config.update(SHARED_PSWD=password, LOGIN_DISABLED=False, WTF_CSRF_ENABLED=False,
+                      CHALLENGE_NAME=app.config['CHALLENGE_NAME'] or 'Load test')
+    cache = None
+    if cache_mb > 0:
+        cache = FileCache(os.path.join(work_dir, 'downloads'), max_bytes=int(cache_mb * 1e6))
+    zip_store = None
+    if prebuild_zips:
+        zip_store = ZipStore(os.path.join(work_dir, 'zips'), cache=cache,
+                             chunk_size=app.config['DOWNLOAD_CHUNK_SIZE'],
+                             workers=app.config['ZIP_FETCH_WORKERS'],
+                             member_timeout=app.config['ZIP_MEMBER_TIMEOUT'],
+                             member_retries=app.config['ZIP_MEMBER_RETRIES'])
+    for module in (app_module, routes):
+        module.DOWNLOAD_CACHE = cache
+        module.ZIP_STORE = zip_store
+
+    # tables are set up here, in place of the first-request crawl of real drives
+    app.before_first_request_funcs = []
+    table = DriveTable(fake.drive_id, drive_name, refresh_minutes=refresh_minutes)
+    table.refresh_callbacks.extend([app_module.publish_listing, app_module.update_zips])
+    app_module.TABLE_DICT.clear()
+    app_module.TABLE_DICT[drive_name] = table
+    app_module.publish_listing()
+    app_module.update_zips()
+    return app
+
+
+class Participant:
+    """Simulated participant, making requests with its own session.
+
+    Args:
+      app (:obj:`flask.Flask`): app under test.
+      password (str): shared password.
+      mix (dict): {action: weight} of requests to make.
+      stats (dict): {action: EndpointStats} to record requests in.
+      think_time (float): mean seconds between requests.
+      seed (int): random seed.
+    """
+
+    def __init__(self, app, password, mix, stats, think_time=1.0, seed=0):
+        self.client = app.test_client()
+        self.password = password
+        self.actions = list(mix)
+        self.weights = list(mix.values())
+        self.stats = stats
+        self.think_time = think_time
+        self.rand = random.Random(seed)
+        self.etag = None
+        self._listing = None
+        self._files = []
+
+    def run(self, stop_time):
+        """Log in and browse, then make requests from the mix until stop_time."""
+        self.request('login')
+        self.request('browse')
+        while True:
+            if self.think_time:
+                time.sleep(self.rand.expovariate(1 / self.think_time))
+            if time.time() >= stop_time:
+                return
+            self.request(self.rand.choices(self.actions, self.weights)[0])
+
+    def request(self, action):
+        """Make request for action, recording latency of the full response."""
+        from blind_challenge.app import LISTING
+
+        if LISTING is not self._listing:
+            self._listing = LISTING
+            self._files = [r for r in LISTING.file_index.values()
+                           if r.mimeType != FOLDER_MIME]
+        files = self._files
+        drive_name = next(iter(LISTING.tables), '')
+        start = time.perf_counter()
+        try:
+            response = self._send(action, files, drive_name)
+            nbytes = len(response.get_data())
+            ok = response.status_code < 400 and not (
+                action != 'login' and response.status_code == 302)
+            if action == 'browse' and response.status_code == 200:
+                self.etag = response.headers.get('ETag')
+            response.close()
+        except Exception:
+            _logger.exception('Request {} failed.'.format(action))
+            nbytes, ok = 0, False
+        self.stats[action].add(time.perf_counter() - start, ok, nbytes, current_rss())
+
+    def _send(self, action, files, drive_name):
+        if action == 'login':
+            return self.client.post('/login', data={'password': self.password})
+        if action == 'browse':
+            headers = {'If-None-Match': self.etag} if self.etag else {}
+            return self.client.get('/', headers=headers)
+        if action == 'download':
+            return self.client.get('/download/{}'.format(self.rand.choice(files).id))
+        if action == 'zip_drive':
+            return self.client.get('/build_zip/{}'.format(drive_name))
+        if action == 'zip_folder':
+            paths = sorted({r.path for r in files if ' > ' in r.path}) or ['']
+            return self.client.get('/build_zip/{}'.format(drive_name),
+                                   query_string={'path': self.rand.choice(paths)})
+        if action == 'zip_selected':
+            selected = self.rand.sample(files, min(5, len(files)))
+            return self.client.post('/build_zip/selected',
+                                    data={'file_id': [r.id for r in selected]})
+        raise ValueError('Unknown action {!r}.'.format(action))
+
+
+def run_load(app, password, users=10, duration=30.0, think_time=1.0, mix=DEFAULT_MIX,
+             ramp_up=0.0, seed=0):
+    """Run simulated participants against app and collect request stats.
+
+    Args:
+      app (:obj:`flask.Flask`): app set up by serve_fake_drive.
+      password (str): shared password.
+      users (int): number of participants.
+      duration (float): seconds to keep making requests.
+      think_time (float): mean seconds between each participant's requests.
+      mix (str or dict): weighted mix of actions, as for parse_mix.
+      ramp_up (float): seconds over which participants arrive.
+      seed (int): random seed.
+
+    Returns:
+      tuple: ({action: EndpointStats}, elapsed seconds).
+    """
+    if isinstance(mix, str):
+        mix = parse_mix(mix)
+    stats = OrderedDict((action, EndpointStats()) for action in ACTIONS)
+    start = time.time()
+    stop_time = start + duration
+    threads = []
+    for i in range(users):
+        participant = Participant(app, password, mix, stats, think_time=think_time,
+                                  seed=seed + i)
+        delay = ramp_up * i / users
+        thread = threading.Timer(delay, participant.run, args=(stop_time,))
+        thread.daemon = True
+        thread.name = 'participant-{}'.format(i)
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats, time.time() - start
+
+
+def format_report(stats, elapsed):
+    """Get text table of stats for each action, and totals.
+
+    Args:
+      stats (dict): {action: EndpointStats}.
+      elapsed (float): duration of run in seconds.
+    """
+    lines = ['{:13s} {:>8s} {:>7s} {:>7s} {:>8s} {:>8s} {:>8s} {:>9s} {:>9s}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'MB sent', 'RSS MB')]
+    total = EndpointStats()
+    for action, endpoint_stats in stats.items():
+        if not endpoint_stats.latencies:
+            continue
+        total.latencies += endpoint_stats.latencies
+        total.errors += endpoint_stats.errors
+        total.bytes += endpoint_stats.bytes
+        total.max_rss = max(total.max_rss, endpoint_stats.max_rss)
+        lines.append(_format_row(action, endpoint_stats.summary(elapsed)))
+    lines.append(_format_row('total', total.summary(elapsed)))
+    lines.append('{:.1f} s elapsed, peak RSS {:.1f} MB'.format(elapsed, peak_rss() / 1e6))
+    return '\n'.join(lines)
+
+
+def _format_row(name, s):
+    return '{:13s} {:8d} {:6.1f}% {:7.1f} {:8.1f} {:8.1f} {:8.1f} {:9.1f} {:9.1f}'.format(
+        name, s['requests'], 100 * s['error_rate'], s['throughput'], 1000 * s['p50'],
+        1000 * s['p95'], 1000 * s['p99'], s['megabytes'], s['max_rss_mb'])
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Load test the app with simulated participants and a fake drive")
+    parser.add_argument(
+        '--version',
+        action='version',
+        version='blind_challenge {ver}'.format(ver=__version__))
+    parser.add_argument('-u', '--users', type=int, default=20,
+                        help="number of simulated participants")
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help="seconds to keep making requests")
+    parser.add_argument('--ramp-up', type=float, default=0,
+                        help="seconds over which participants arrive")
+    parser.add_argument('--think', type=float, default=1.0,
+                        help="mean seconds between each participant's requests")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="weighted mix of actions (default: %(default)s)")
+    parser.add_argument('--depth', type=int, default=3, help="folder levels in fake drive")
+    parser.add_argument('--fanout', type=int, default=4, help="sub-folders per folder")
+    parser.add_argument('--files', type=int, default=10, help="files per folder")
+    parser.add_argument('--docs', type=int, default=1, help="Google Docs per folder")
+    parser.add_argument('--file-size', type=int, nargs=2, default=(10000, 2000000),
+                        metavar=('MIN', 'MAX'), help="range of file sizes in bytes")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds of fake Drive latency per API request")
+    parser.add_argument('--no-prebuild-zips', dest='prebuild_zips', action='store_false',
+                        help="stream every zip instead of building them in advance")
+    parser.add_argument('--cache-mb', type=float, default=512,
+                        help="download cache size, 0 to disable")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action='store_const',
+        const=logging.INFO)
+    parser.add_argument(
+        '-vv',
+        '--very-verbose',
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action='store_const',
+        const=logging.DEBUG)
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(level=loglevel, stream=sys.stdout,
+                        format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
+    logging.getLogger().setLevel(loglevel or logging.WARNING)
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+    mix = parse_mix(args.mix)
+    fake = FakeDrive.generate(depth=args.depth, fanout=args.fanout,
+                              files_per_folder=args.files, docs_per_folder=args.docs,
+                              file_size=tuple(args.file_size), latency=args.latency,
+                              seed=args.seed)
+    _logger.info('Fake drive has {} folders and {} files.'.format(
+        fake.folder_count, len(fake.files) - fake.folder_count + 1))
+    password = 'load-test-{}'.format(random.getrandbits(32))
+    with tempfile.TemporaryDirectory(prefix='blind_load_') as work_dir:
+        app = serve_fake_drive(fake, 'Load test drive', password, work_dir,
+                               prebuild_zips=args.prebuild_zips, cache_mb=args.cache_mb)
+        stats, elapsed = run_load(app, password, users=args.users, duration=args.duration,
+                                  think_time=args.think, mix=mix, ramp_up=args.ramp_up,
+                                  seed=args.seed)
+    print(format_report(stats, elapsed))
+    print('{} Drive API requests.'.format(fake.request_count))
+
+
+def run():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -1,11 +1,36 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for blind_challenge.
+    conftest.py for blind_challenge.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     https://pytest.org/latest/plugins.html
 """
 
-# import pytest
+import pytest
+
+from blind_challenge.fake_drive import FakeDrive
+
+
+@pytest.fixture
+def use_fake_drive(monkeypatch):
+    """Point Drive API calls in blind_challenge.app.drive at a FakeDrive.
+
+    Returns a function taking a FakeDrive, so tests can build drives of
+    whatever shape they need.
+    """
+    from blind_challenge.app import drive
+
+    def install(fake):
+        service = fake.build_service()
+        monkeypatch.setattr(drive, 'get_files_service', lambda: service)
+        monkeypatch.setattr(drive, 'get_http', lambda: fake)
+        return fake
+
+    return install
+
+
+@pytest.fixture
+def fake_drive(use_fake_drive):
+    """Small fake drive, installed for blind_challenge.app.drive."""
+    return use_fake_drive(FakeDrive.generate(depth=2, fanout=3, files_per_folder=4))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import threading
+from unittest import mock
+
+from google.auth import credentials
+import pandas as pd
+
+from blind_challenge.app import drive
+from blind_challenge.app.admin import ApiTable, DriveTable, HttpPool
+from blind_challenge.app.helpers import load_pickle, save_pickle
+from blind_challenge.fake_drive import FakeDrive
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+class FakeCredentials(credentials.Credentials):
+    def __init__(self):
+        super().__init__()
+        self.refresh_count = 0
+
+    def refresh(self, request):
+        self.refresh_count += 1
+        self.token = 'token {}'.format(self.refresh_count)
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+class CountingDrive(FakeDrive):
+    """FakeDrive recording the most requests in progress at once."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.active = 0
+        self.max_active = 0
+        self._active_lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._active_lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return super().request(*args, **kwargs)
+        finally:
+            with self._active_lock:
+                self.active -= 1
+
+
+class BlockingTable(ApiTable):
+    """Table whose background refreshes wait until released."""
+
+    def __init__(self):
+        self.refreshes = 0
+        self.fail = False
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.finished = threading.Event()
+        super().__init__(refresh_minutes=0)  # stale as soon as loaded
+
+    def refresh_df(self):
+        self.refreshes += 1
+        if self.refreshes > 1:  # first refresh is the synchronous load
+            self.started.set()
+            assert self.release.wait(5)
+        if self.fail:
+            raise RuntimeError('Drive unavailable')
+        self._df = 'data {}'.format(self.refreshes)
+
+    def _run_refresh(self):
+        super()._run_refresh()
+        self.finished.set()
+
+    def wait_for_refresh(self):
+        self.release.set()
+        assert self.finished.wait(5)
+
+
+def test_stale_table_refreshes_in_background():
+    table = BlockingTable()
+    refreshed = []
+    table.refresh_callbacks.append(refreshed.append)
+    assert table.df == 'data 1'  # old data straight away, refresh started
+    assert table.started.wait(5)
+    assert table.df == 'data 1' and not table.refresh_in_background()
+    assert table.refreshes == 2  # only one refresh at a time
+    table.wait_for_refresh()
+    assert table.current_df == 'data 2' and refreshed == [table]
+
+
+def test_failed_refresh_keeps_data():
+    table = BlockingTable()
+    refreshed = []
+    table.refresh_callbacks.append(refreshed.append)
+    table.fail = True
+    loaded = table.last_refresh
+    assert table.refresh_in_background()
+    table.wait_for_refresh()
+    assert table.current_df == 'data 1' and refreshed == []
+    # counted as a refresh, so a broken Drive isn't retried on every request
+    assert table.last_refresh > loaded
+
+
+def test_drive_table_starts_from_snapshot(use_fake_drive, tmpdir):
+    fake = use_fake_drive(FakeDrive.generate(depth=1, fanout=2, files_per_folder=3))
+    snapshot_dir = str(tmpdir.join('snapshots'))
+    crawled = DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir)
+    requests = fake.request_count
+
+    table = DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir)
+    assert fake.request_count == requests  # no crawl
+    pd.testing.assert_frame_equal(table.current_df, crawled.current_df)
+    assert table.last_refresh < datetime.datetime.utcnow()
+    assert set(table.index) == set(crawled.index)
+
+    # snapshots of another format or drive are ignored
+    with mock.patch.object(DriveTable, 'snapshot_format', DriveTable.snapshot_format + 1):
+        DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir)
+    assert fake.request_count > requests
+    requests = fake.request_count
+    snapshot = load_pickle(table.snapshot_path)
+    save_pickle(dict(snapshot, root_folder_id='other-drive'), table.snapshot_path)
+    DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir)
+    assert fake.request_count > requests
+
+    # as are snapshots other users could have written
+    requests = fake.request_count
+    os.chmod(table.snapshot_path, 0o666)
+    DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir)
+    assert fake.request_count > requests
+
+
+def test_stale_snapshot_refreshes_in_background(use_fake_drive, tmpdir):
+    fake = use_fake_drive(FakeDrive.generate(depth=1, fanout=2, files_per_folder=3))
+    snapshot_dir = str(tmpdir.join('snapshots'))
+    DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir)
+    fake.add_file('new.pdf')
+    requests = fake.request_count
+    opened = threading.Event()
+    request = fake.request
+    fake.request = lambda *args, **kwargs: opened.wait(5) and request(*args, **kwargs)
+
+    table = DriveTable(fake.drive_id, 'Drive', snapshot_dir=snapshot_dir, refresh_minutes=0)
+    refreshed = threading.Event()
+    table.refresh_callbacks.append(lambda t: refreshed.set())
+    assert fake.request_count == requests
+    assert 'new.pdf' not in table.df['title'].values  # snapshot served while stale
+    opened.set()  # let the background refresh reach Drive
+    assert refreshed.wait(5)
+    assert fake.request_count > requests
+    assert 'new.pdf' in table.current_df['title'].values
+
+
+def test_http_pool_shares_connections_and_token(use_fake_drive, monkeypatch):
+    fake = CountingDrive.generate(depth=1, fanout=4, files_per_folder=2, latency=0.02)
+    use_fake_drive(fake)
+    connections = []
+
+    def http_factory():
+        connections.append(object())
+        return fake
+
+    creds = FakeCredentials()
+    pool = HttpPool(creds, size=3, http_factory=http_factory)
+    monkeypatch.setattr(drive, 'get_http', lambda: pool)
+    file_ids = [i for i, f in fake.files.items() if 'size' in f]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        contents = list(executor.map(drive.download_raw_file, file_ids * 3))
+
+    assert [c.getvalue() for c in contents[:len(file_ids)]] == [
+        fake.content(i, 1024) for i in file_ids]
+    assert pool.created == len(connections) == 3
+    assert 1 < fake.max_active <= 3
+    assert creds.refresh_count == 1
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import zipfile
+
+import pytest
+
+from blind_challenge.app import drive
+from blind_challenge.app.archive import ZipStore
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_zip_store_builds_on_change(fake_drive, tmpdir):
+    store = ZipStore(str(tmpdir), keep=2)
+    files = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True)
+    assert store.latest('Drive') is None
+
+    store.update('Drive', files)
+    store._builders['Drive'].join()
+    first = store.latest('Drive')
+    with zipfile.ZipFile(first) as zf:
+        assert len(zf.namelist()) == len(files)
+
+    count = fake_drive.request_count
+    assert store.build('Drive', files) == first
+    assert fake_drive.request_count == count  # unchanged listing is not rebuilt
+
+    paths = [first]
+    for title in ('renamed.pdf', 'renamed again.pdf'):
+        files.loc[files.index[0], 'title'] = title
+        paths.append(store.build('Drive', files))
+        os.utime(paths[-1], (os.path.getmtime(paths[-2]) + 1,) * 2)
+    assert store.latest('Drive') == paths[-1]
+    assert sorted(store._scope_paths('Drive')) == sorted(paths[1:])  # oldest removed
+
+
+def test_zip_store_skips_locked_build(fake_drive, tmpdir):
+    store = ZipStore(str(tmpdir))
+    files = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True)
+    path = store.path('Drive', drive.listing_fingerprint(files))
+    open(path + '.lock', 'w').close()
+    assert store.build('Drive', files) is None
+    assert store.latest('Drive') is None
+
+
+def test_zip_store_discards_incomplete_build(fake_drive, tmpdir):
+    store = ZipStore(str(tmpdir))
+    files = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True)
+    fake_drive.media_failures[files.id.iloc[0]] = 1
+    with pytest.raises(RuntimeError):
+        store.build('Drive', files)
+    assert store.latest('Drive') is None
+    assert os.listdir(str(tmpdir)) == []  # no partial archive or lock left
+
+    path = store.build('Drive', files)  # retried, e.g. on the next refresh
+    assert store.latest('Drive') == path
+    with zipfile.ZipFile(path) as zf:
+        assert 'MISSING_FILES.txt' not in zf.namelist()
+
+
+def test_zip_store_keeps_build_missing_undownloadable(fake_drive, tmpdir):
+    store = ZipStore(str(tmpdir))
+    fake_drive.add_file('Survey', mime_type='application/vnd.google-apps.form')
+    files = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True)
+    path = store.build('Drive', files)
+    with zipfile.ZipFile(path) as zf:
+        assert len(zf.namelist()) == len(files)  # all but form, plus missing list
+        assert b'Survey' in zf.read('MISSING_FILES.txt')
+
+    count = fake_drive.request_count
+    assert store.build('Drive', files) == path
+    assert fake_drive.request_count == count  # not rebuilt on next refresh
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of crawling, listing, downloads and browse rendering,
+run against a FakeDrive.
+
+Wall-clock timings vary between machines, so benchmarks are skipped unless
+BENCHMARK or BENCHMARK_SAVE is set:
+
+    BENCHMARK=1 py.test tests/test_benchmarks.py
+
+Each benchmark takes the best of a few runs and is compared with the time
+stored in benchmark_baseline.json, failing if it is more than
+BENCHMARK_TOLERANCE (default 3) times slower. To store new baselines, run:
+
+    BENCHMARK_SAVE=1 py.test tests/test_benchmarks.py
+"""
+
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+import pytest
+
+import blind_challenge
+from blind_challenge.app import app, drive, routes
+from blind_challenge.app.admin import DriveTable
+from blind_challenge.app.cache import FileCache
+from blind_challenge.app.helpers import (load_pickle, parse_timestamp_str, parse_timestamps,
+                                        save_pickle)
+from blind_challenge.app.listing import ListingSnapshot
+from blind_challenge.app.search import SearchIndex
+from blind_challenge.fake_drive import FakeDrive
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 3))
+SLACK = 0.02  # seconds allowed on top, for timings near timer noise
+
+pytestmark = pytest.mark.skipif(
+    not (os.environ.get('BENCHMARK') or os.environ.get('BENCHMARK_SAVE')),
+    reason='set BENCHMARK=1 to run benchmarks')
+
+
+def _report(request, lines):
+    """Write lines to the terminal, past pytest's output capturing."""
+    reporter = request.config.pluginmanager.getplugin('terminalreporter')
+    capture = request.config.pluginmanager.getplugin('capturemanager')
+    if reporter is None:
+        return
+    with capture.global_and_fixture_disabled():
+        for line in lines:
+            reporter.write_line(line)
+
+
+@pytest.fixture(scope='module')
+def benchmark_results(request):
+    """Collect best time of each benchmark, reporting and saving them at the end."""
+    results = {}
+    yield results
+    try:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    lines = ['\n{:40s} {:>10s} {:>10s} {:>7s}'.format('benchmark', 'seconds', 'baseline',
+                                                       'ratio')]
+    for name, seconds in sorted(results.items()):
+        base = baseline.get(name)
+        lines.append('{:40s} {:10.4f} {:>10s} {:>7s}'.format(
+            name, seconds, '{:.4f}'.format(base) if base else '-',
+            '{:.2f}'.format(seconds / base) if base else '-'))
+    _report(request, lines)
+    if os.environ.get('BENCHMARK_SAVE'):
+        baseline.update({k: round(v, 4) for k, v in results.items()})
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture
+def benchmark(benchmark_results):
+    """Get function timing func() as the named benchmark, returning its result."""
+
+    def run(name, func, repeat=3, setup=None):
+        best = None
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        benchmark_results[name] = best
+        if not os.environ.get('BENCHMARK_SAVE'):
+            with open(BASELINE_PATH) as f:
+                baseline = json.load(f).get(name)
+            if baseline is not None:
+                assert best <= baseline * TOLERANCE + SLACK, (
+                    '{} took {:.4f} s, baseline {:.4f} s'.format(name, best, baseline))
+        return result
+
+    return run
+
+
+@pytest.fixture
+def large_drive(use_fake_drive):
+    """Drive of 156 folders and 3276 files, with no latency."""
+    return use_fake_drive(FakeDrive.generate(depth=3, fanout=5, files_per_folder=20,
+                                             docs_per_folder=1))
+
+
+@pytest.mark.parametrize('fanout', [2, 3, 5])
+def test_extract_folders(use_fake_drive, benchmark, benchmark_results, fanout):
+    """Crawl time against folder count, folder by folder and concurrently."""
+    fake = use_fake_drive(FakeDrive.generate(depth=2, fanout=fanout, files_per_folder=5,
+                                             latency=0.005))
+    name = 'extract_folders_{}_folders'.format(fake.folder_count)
+    folder_dict, title_dict = benchmark(name + '_serial',
+                                        lambda: drive.extract_folders(fake.drive_id))
+    assert len(folder_dict) == fake.folder_count
+    benchmark(name + '_8_workers',
+              lambda: drive.extract_folders(fake.drive_id, max_workers=8))
+    assert benchmark_results[name + '_8_workers'] < benchmark_results[name + '_serial']
+
+
+def test_file_tree_to_df(large_drive, benchmark):
+    files = benchmark('file_tree_to_df_flat',
+                      lambda: drive.file_tree_to_df(large_drive.drive_id, 'Drive', flat=True))
+    assert len(files) == 21 * large_drive.folder_count
+    benchmark('file_tree_to_df_folders',
+              lambda: drive.file_tree_to_df(large_drive.drive_id, 'Drive'), repeat=1)
+
+
+def test_drive_table_refresh(large_drive, benchmark):
+    table = DriveTable(large_drive.drive_id, 'Drive', incremental=True)
+    benchmark('drive_table_refresh_crawl', table._refresh_from_crawl)
+    file_ids = [i for i, f in large_drive.files.items() if 'size' in f]
+
+    def change_files():
+        for file_id in file_ids[:10]:
+            large_drive.update_file(file_id, name='changed {}'.format(time.perf_counter()))
+
+    benchmark('drive_table_refresh_changes', table.refresh_df, setup=change_files)
+    assert table.current_df.title.str.startswith('changed').sum() == 10
+
+
+def test_download_file(use_fake_drive, tmpdir, benchmark):
+    fake = use_fake_drive(FakeDrive.generate(depth=0, files_per_folder=1,
+                                             file_size=16 * 1024 * 1024))
+    file_id = next(iter(fake.files))
+    args = (file_id, 'file 0.pdf', 'application/pdf')
+    cache = FileCache(str(tmpdir), max_bytes=10 ** 9)
+    fh, filename, mime_out = benchmark('download_file_16mb',
+                                       lambda: drive.download_file(*args))
+    assert len(fh.getvalue()) == 16 * 1024 * 1024
+    drive.download_file(*args, version='v1', cache=cache)
+    benchmark('download_file_16mb_cached',
+              lambda: drive.download_file(*args, version='v1', cache=cache))
+
+
+def test_download_folder_zip(use_fake_drive, benchmark):
+    fake = use_fake_drive(FakeDrive.generate(depth=1, fanout=4, files_per_folder=10,
+                                             file_size=(10000, 200000), docs_per_folder=1))
+    files = drive.file_tree_to_df(fake.drive_id, 'Drive', flat=True)
+    zipped = benchmark('download_folder_zip_55_files',
+                       lambda: drive.download_folder_zip(files))
+    assert zipped.getvalue().startswith(b'PK')
+
+
+def test_browse_rendering(large_drive, benchmark):
+    files = drive.file_tree_to_df(large_drive.drive_id, 'Drive', flat=True)
+    listing = ListingSnapshot(1, {'Drive': files}, DriveTable.cols_show,
+                              {'Drive': drive.index_files(files, 'Drive')})
+    with app.test_request_context('/'):
+        html = benchmark('browse_render_3276_files', lambda: routes.render_browse(listing))
+    assert html.count('name="file_id"') == len(files)
+
+
+def _resources(n_files, files_per_folder=100):
+    """Get JSON of Drive file resources for a drive with n_files files."""
+    n_folders = n_files // files_per_folder
+    resources = []
+    for i in range(n_folders):
+        resources.append({
+            'kind': 'drive#file', 'id': 'folder{}'.format(i), 'name': 'folder {}'.format(i),
+            'mimeType': 'application/vnd.google-apps.folder', 'trashed': False,
+            'parents': ['folder{}'.format((i - 1) // 10) if i else 'drive'],
+            'createdTime': '2019-01-01T00:00:00.000Z', 'modifiedTime': '2019-01-01T00:00:00.000Z',
+        })
+    for i in range(n_files):
+        resources.append({
+            'kind': 'drive#file', 'id': 'id{:08d}'.format(i), 'name': 'file {}.pdf'.format(i),
+            'mimeType': 'application/pdf', 'trashed': False,
+            'parents': ['folder{}'.format(i % n_folders)],
+            'createdTime': '2019-01-01T00:00:00.000Z',
+            'modifiedTime': '2019-02-01T10:{:02d}:00.000Z'.format(i % 60),
+            'lastModifyingUser': {'displayName': 'User {}'.format(i % 20)},
+            'iconLink': 'https://example.com/icon/application/pdf',
+            'webViewLink': 'https://example.com/view/{}'.format(i),
+            'md5Checksum': '{:032x}'.format(i),
+        })
+    return json.dumps(resources)
+
+
+def _traced_mb(build, raw):
+    """Get result of build(json.loads(raw)) and megabytes it holds on to."""
+    gc.collect()
+    tracemalloc.start()
+    result = build(json.loads(raw))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size / 1e6
+
+
+@pytest.mark.parametrize('n_files', [10000, 100000])
+def test_listing_to_df(benchmark, n_files):
+    raw = _resources(n_files)
+    entries, entries_mb = _traced_mb(drive.tidy_files, raw)
+    frame, frame_mb = _traced_mb(pd.DataFrame.from_records, raw)
+    assert entries_mb < frame_mb  # listing records are leaner than a DataFrame
+    files = benchmark('listing_to_df_{}k_files'.format(n_files // 1000),
+                      lambda: drive.listing_to_df(entries, 'drive', 'Drive'), repeat=1)
+    assert len(files) == n_files
+
+
+def test_snapshot_load(tmpdir, benchmark, benchmark_results):
+    """Startup from a saved listing should take well under a second for 50k files."""
+    entries = drive.tidy_files(json.loads(_resources(50000)))
+    path = str(tmpdir.join('snapshot.pickle'))
+    save_pickle({'df': drive.listing_to_df(entries, 'drive', 'Drive'), 'listing': entries},
+                path)
+    snapshot = benchmark('snapshot_load_50k', lambda: load_pickle(path))
+    assert len(snapshot['df']) == 50000
+    assert benchmark_results['snapshot_load_50k'] < 1
+
+
+def test_parse_timestamps(benchmark, benchmark_results):
+    values = ['2019-{:02d}-{:02d}T10:{:02d}:{:02d}.{:03d}Z'.format(
+        i % 12 + 1, i % 28 + 1, i % 60, i // 60 % 60, i % 1000) for i in range(100000)]
+    benchmark('parse_timestamps_100k', lambda: parse_timestamps(values))
+    benchmark('parse_timestamp_str_2k', lambda: [parse_timestamp_str(i) for i in values[:2000]],
+              repeat=1)
+    # row by row is too slow to run in full, so compare with 2k rows
+    assert (benchmark_results['parse_timestamps_100k']
+            < benchmark_results['parse_timestamp_str_2k'])
+
+
+def test_search(benchmark):
+    listing = pd.DataFrame(
+        [('id{}'.format(i), 'file {} report {}.pdf'.format(i, i % 97),
+          'folder {} > sub {}'.format(i % 50, i % 7), 'application/pdf', pd.Timestamp(2019, 1, 1))
+         for i in range(50000)],
+        columns=['id', 'title', 'path_show', 'mimeType', 'date_modified'])
+    index = SearchIndex(listing, 'Drive')
+    hits = benchmark('search_50k_files', lambda: index.search('report 42 sub', limit=20))
+    assert len(hits) == 20
+
+
+def test_import_app(benchmark, request):
+    """Time app import, reporting slowest imports python -X importtime style."""
+    src_dir = os.path.dirname(os.path.dirname(blind_challenge.__file__))
+    env = dict(os.environ, PYTHONPATH=src_dir)
+    proc = benchmark('import_app', lambda: subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import blind_challenge.app'], env=env,
+        stderr=subprocess.PIPE, universal_newlines=True, check=True))
+    timings = []  # will hold (cumulative us, module)
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative, module = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                timings.append((int(cumulative), module.rstrip()))
+    total = dict((m.strip(), t) for t, m in timings)['blind_challenge.app']
+    lines = ['\nimport blind_challenge.app: {:.3f} s; slowest imports:'.format(total / 1e6)]
+    for cumulative, module in sorted(timings, reverse=True)[:10]:
+        lines.append('{:8.3f} s  {}'.format(cumulative / 1e6, module))
+    _report(request, lines)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from blind_challenge.app.cache import FileCache
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_cache_round_trip(tmpdir):
+    cache = FileCache(str(tmpdir), max_bytes=1000)
+    key = cache.make_key('file_id', '2019-01-01 00:00:00:abc', 'application/pdf')
+    assert cache.get(key) is None
+    cache.put(key, b'content')
+    assert cache.get(key) == b'content'
+    assert key != cache.make_key('file_id', '2019-01-02 00:00:00:abc', 'application/pdf')
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = FileCache(str(tmpdir), max_bytes=250)
+    keys = [cache.make_key(i) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.put(key, b'x' * 100)
+        past = time.time() - 100 + i
+        os.utime(cache.path(key), (past, past))
+    assert cache.get(keys[0])  # now most recently used
+    cache.put(keys[2], b'x' * 100)
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import threading
+import time
+import zipfile
+
+import pandas as pd
+
+from blind_challenge.app import drive
+from blind_challenge.app.cache import FileCache
+from blind_challenge.fake_drive import FakeDrive
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def _sorted(df):
+    return df.sort_values('id').reset_index(drop=True)
+
+
+def test_crawl_modes_match(fake_drive):
+    fake_drive.add_file('in trash.pdf', trashed=True)
+    serial = drive.file_tree_to_df(fake_drive.drive_id, 'Drive')
+    flat = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True)
+    concurrent = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', max_workers=4)
+    assert len(serial) == 4 * fake_drive.folder_count
+    pd.testing.assert_frame_equal(_sorted(serial), _sorted(flat))
+    pd.testing.assert_frame_equal(_sorted(serial), _sorted(concurrent))
+
+
+def test_flat_crawl_lists_drive_in_few_requests(fake_drive):
+    from blind_challenge.app.admin import DriveTable
+
+    fake_drive.add_file('lost.pdf', parent_id='missing-folder')  # not reachable from root
+    table = DriveTable(fake_drive.drive_id, 'Drive', incremental=False)  # default mode
+    assert fake_drive.request_count == 1
+    assert len(table.df) == 4 * fake_drive.folder_count
+    assert 'lost.pdf' not in set(table.df.title)
+
+    fake_drive.request_count = 0
+    crawled = drive.file_tree_to_df(fake_drive.drive_id, 'Drive')
+    assert fake_drive.request_count == fake_drive.folder_count
+    pd.testing.assert_frame_equal(_sorted(crawled), _sorted(table.df[crawled.columns]))
+
+
+def test_folder_paths_with_cycles_and_orphans():
+    def entry(file_id, parent_id, folder=False):
+        mime_type = 'application/vnd.google-apps.folder' if folder else 'application/pdf'
+        return drive.ListingEntry(file_id, file_id.upper(), mime_type, parent_id,
+                                  '2019-01-01T00:00:00.000Z', '2019-01-01T00:00:00.000Z')
+
+    depth = 2000
+    listing = [entry('f0', 'drive', folder=True), entry('x0', 'drive')]
+    for i in range(1, depth):
+        listing += [entry('f{}'.format(i), 'f{}'.format(i - 1), folder=True),
+                    entry('x{}'.format(i), 'f{}'.format(i - 1))]
+    listing.append(entry('f0', 'f{}'.format(depth - 1), folder=True))  # cycle back to f0
+    folder_dict, title_dict = drive.listing_to_folders(listing, 'drive')
+    folder_dict['orphan'] = drive.Folder('orphan', files=[entry('lost', 'orphan')])
+
+    start = time.perf_counter()
+    files = drive.folders_to_df(folder_dict, title_dict, 'Drive').set_index('id')
+    assert time.perf_counter() - start < 5
+    assert len(files) == depth and 'lost' not in files.index
+    assert files.loc['x0', 'path'] == files.loc['x0', 'path_show'] == 'Drive'
+    assert files.loc['x1', 'path'] == 'Drive > F0'
+    assert files.loc['x1', 'path_show'] == 'F0'
+    assert files.loc['x3', 'path_show'] == 'F0 > F1 > F2'
+    assert files.loc['x{}'.format(depth - 1), 'path'].count(' > ') == depth - 1
+
+
+def test_listing_follows_page_tokens(fake_drive):
+    records = list(drive.list_file_records('trashed = false',
+                                           drive_id=fake_drive.drive_id, page_size=10))
+    assert len(records) == len(fake_drive.files)
+    assert fake_drive.request_count == -(-len(records) // 10)
+
+
+def test_concurrent_crawl_output(fake_drive):
+    serial = drive.extract_folders(fake_drive.drive_id)
+    concurrent = drive.extract_folders(fake_drive.drive_id, max_workers=4)
+    assert serial[1] == concurrent[1]
+    assert set(serial[0]) == set(concurrent[0])
+
+
+def test_apply_changes_matches_fresh_listing(fake_drive):
+    drive_id = fake_drive.drive_id
+    token = drive.get_start_page_token(drive_id)
+    listing = drive.get_drive_files(drive_id)
+
+    file_ids = [i for i, f in fake_drive.files.items() if not f['mimeType'].endswith('folder')]
+    folder_ids = [i for i in fake_drive.files if i not in file_ids]
+    new_folder = fake_drive.add_folder('new folder', parent_id=folder_ids[0])
+    fake_drive.add_file('new file.pdf', parent_id=new_folder)
+    fake_drive.update_file(file_ids[0], name='renamed.pdf')
+    fake_drive.update_file(file_ids[1], parents=[folder_ids[-1]])
+    fake_drive.update_file(folder_ids[1], name='renamed folder')
+    fake_drive.trash_file(file_ids[2])
+    fake_drive.delete_file(file_ids[3])
+
+    changes, new_token = drive.get_changes(drive_id, token, page_size=3)
+    assert len(changes) == 7
+    assert drive.get_changes(drive_id, new_token)[0] == []
+
+    updated = drive.listing_to_df(drive.apply_changes(listing, changes), drive_id, 'Drive')
+    expected = drive.file_tree_to_df(drive_id, 'Drive')
+    cols = ['id', 'title', 'path', 'path_show', 'date_modified']
+    pd.testing.assert_frame_equal(_sorted(updated)[cols], _sorted(expected)[cols])
+
+
+def test_refresh_records_in_batches(use_fake_drive, monkeypatch):
+    monkeypatch.setattr(drive.time, 'sleep', lambda seconds: None)
+    fake = use_fake_drive(FakeDrive.generate(depth=0, files_per_folder=250))
+    records = list(drive.iter_records(drive.file_tree_to_df(fake.drive_id, 'Drive')))
+    renamed, modified, trashed, deleted, flaky, failing = [r.id for r in records[:6]]
+    fake.update_file(renamed, name='renamed.pdf')
+    fake.update_file(modified, md5Checksum='new md5')
+    fake.trash_file(trashed)
+    fake.delete_file(deleted)
+    fake.metadata_failures[flaky] = 1
+    fake.metadata_failures[failing] = 10
+
+    count = fake.request_count
+    refreshed = drive.refresh_records(records, batch_size=100)
+    assert fake.request_count == count + 3 + 3  # 3 batches, then 3 retry batches
+    assert [r.id for r in refreshed] == [r.id for r in records if r.id not in (trashed, deleted)]
+    by_id = {r.id: r for r in refreshed}
+    assert by_id[renamed].title == 'renamed.pdf'
+    assert drive.file_version(by_id[renamed]) != drive.file_version(records[0])
+    assert by_id[modified].md5 == 'new md5'
+    assert by_id[failing] is records[5]  # not checked, so kept as listed
+    unchanged = records[-1]
+    assert by_id[unchanged.id] == unchanged
+    assert drive.file_version(by_id[unchanged.id]) == drive.file_version(unchanged)
+
+
+def test_download_file_cache(fake_drive, tmpdir):
+    cache = FileCache(str(tmpdir), max_bytes=10 ** 6)
+    doc_id = fake_drive.add_file('notes', mime_type='application/vnd.google-apps.document')
+    files = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True).set_index('id')
+    pdf_id = files.index[~files.mimeType.str.startswith('application/vnd.google-apps')][0]
+
+    for file_id in (pdf_id, doc_id):
+        info = files.loc[file_id]
+        args = (file_id, info.title, info.mimeType)
+        fh, filename, mime_out = drive.download_file(*args, version=drive.file_version(info),
+                                                     cache=cache)
+        count = fake_drive.request_count
+        cached = drive.download_file(*args, version=drive.file_version(info), cache=cache)
+        assert fake_drive.request_count == count
+        assert cached[0].getvalue() == fh.getvalue()
+        assert cached[1:] == (filename, mime_out)
+        drive.download_file(*args, version='new version', cache=cache)
+        assert fake_drive.request_count > count
+    assert filename == 'notes.pdf'
+    assert fh.getvalue().startswith(b'Export of')
+
+
+def test_stream_file_chunks(use_fake_drive, tmpdir):
+    fake = use_fake_drive(FakeDrive.generate(depth=0, files_per_folder=1, file_size=10000))
+    file_id = next(iter(fake.files))
+    cache = FileCache(str(tmpdir), max_bytes=10 ** 6)
+    args = (file_id, 'file 0.pdf', 'application/pdf')
+
+    fake.media_delays[file_id] = 0.05
+    slow, filename, mime_out, size = drive.stream_file(*args, version='v1', cache=cache,
+                                                       chunk_size=3000)
+    assert size == 10000
+    next(slow)  # client reading slowly doesn't hold up others
+
+    chunks, filename, mime_out, size = drive.stream_file(*args, version='v1', cache=cache,
+                                                         chunk_size=3000, lock_timeout=5)
+    chunks = list(chunks)
+    assert [len(i) for i in chunks] == [3000, 3000, 3000, 1000]
+    assert b''.join(chunks) == fake.content(file_id, 10000)
+    slow.close()
+    assert fake.request_count == 4  # one shared download, of four chunks
+
+    count = fake.request_count
+    cached, filename, mime_out, size = drive.stream_file(*args, version='v1', cache=cache)
+    assert b''.join(cached) == b''.join(chunks)
+    assert size == 10000
+    assert fake.request_count == count
+
+
+def test_concurrent_streams_download_once(use_fake_drive, tmpdir):
+    fake = use_fake_drive(FakeDrive.generate(depth=0, files_per_folder=1, file_size=10000))
+    file_id = next(iter(fake.files))
+    fake.media_delays[file_id] = 0.05
+    cache = FileCache(str(tmpdir), max_bytes=10 ** 6)
+
+    def download(i):
+        chunks, filename, mime_out, size = drive.stream_file(
+            file_id, 'file 0.pdf', 'application/pdf', version='v1', cache=cache,
+            chunk_size=3000)
+        return b''.join(chunks)
+
+    with ThreadPoolExecutor(4) as executor:
+        contents = list(executor.map(download, range(4)))
+    assert contents == [fake.content(file_id, 10000)] * 4
+    assert fake.request_count == 4  # one download, of four chunks
+
+    # a request that can't wait for the cache streams from Drive instead
+    with cache.lock(cache.make_key(file_id, 'v2', 'application/pdf')):
+        chunks, filename, mime_out, size = drive.stream_file(
+            file_id, 'file 0.pdf', 'application/pdf', version='v2', cache=cache,
+            lock_timeout=0)
+        assert b''.join(chunks) == contents[0]
+    assert cache.get(cache.make_key(file_id, 'v2', 'application/pdf')) is None
+
+
+def test_iter_folder_zip(use_fake_drive, tmpdir):
+    fake = use_fake_drive(FakeDrive.generate(depth=1, fanout=2, files_per_folder=2,
+                                             file_size=5000))
+    doc_id = fake.add_file('notes', mime_type='application/vnd.google-apps.document')
+    pdf_id = fake.add_file('Notes.pdf')  # clashes with export of doc
+    files = drive.file_tree_to_df(fake.drive_id, 'Drive', flat=True)
+    files = files.sort_values(['path', 'id'])
+
+    count = fake.request_count
+    chunks = drive.iter_folder_zip(files, chunk_size=1000, base_path='Drive')
+    first = next(chunks)
+    assert first.startswith(b'PK\x03\x04')  # local header of first member
+    assert fake.request_count == count + 1  # sent after first chunk is fetched
+
+    with zipfile.ZipFile(io.BytesIO(first + b''.join(chunks))) as zf:
+        assert zf.testzip() is None
+        names = dict(zip(files.id, zf.namelist()))
+        assert len(names) == len(files) == len(set(names.values()))
+        assert names[doc_id] == 'notes.pdf' and names[pdf_id] == 'Notes (2).pdf'
+        assert zf.read('notes.pdf').startswith(b'Export of')
+        for file_id, path, title in zip(files.id, files.path, files.title):
+            if path != 'Drive':  # in a sub-folder
+                folder = path.split(' > ', 1)[1].replace(' > ', '/')
+                assert names[file_id] == folder + '/' + title
+                assert zf.read(names[file_id]) == fake.content(file_id, 5000)
+
+
+def test_sequential_zip_lists_failed_members(use_fake_drive):
+    fake = use_fake_drive(FakeDrive.generate(depth=0, files_per_folder=3, file_size=5000))
+    files = drive.file_tree_to_df(fake.drive_id, 'Drive', flat=True).sort_values('title')
+    file_ids, titles = list(files.id), list(files.title)
+    fake.media_failures[file_ids[1]] = 1
+
+    chunks = drive.iter_folder_zip(files, chunk_size=1000, base_path='Drive')
+    first = next(chunks)
+    fake.media_failures[file_ids[0]] = 1  # second chunk of first member fails
+    with zipfile.ZipFile(io.BytesIO(first + b''.join(chunks))) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [titles[0], titles[2], 'MISSING_FILES.txt']
+        assert zf.read(titles[0]) == fake.content(file_ids[0], 5000)[:1000]
+        assert zf.read(titles[2]) == fake.content(file_ids[2], 5000)
+        missing = zf.read('MISSING_FILES.txt').decode('utf-8').splitlines()
+    assert len(missing) == 2
+    assert titles[0] + ': incomplete' in missing[0] and titles[1] in missing[1]
+
+
+class StallingDrive(FakeDrive):
+    """FakeDrive whose first download of each file stalls until released."""
+    stall = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.released = threading.Event()
+
+    def _get_media(self, file_id, headers):
+        with self._lock:
+            first = file_id not in self.media_delays
+            self.media_delays[file_id] = 0
+        if first:
+            self.released.wait(self.stall)
+        return super()._get_media(file_id, headers)
+
+
+def test_prefetch_retry_skips_stalled_cache_fill(use_fake_drive, tmpdir):
+    fake = use_fake_drive(StallingDrive.generate(depth=0, files_per_folder=1))
+    files = drive.file_tree_to_df(fake.drive_id, 'Drive', flat=True)
+    cache = FileCache(str(tmpdir), max_bytes=10 ** 6)
+    start = time.perf_counter()
+    zipped = b''.join(drive.iter_folder_zip(files, cache=cache, workers=2, member_timeout=0.2,
+                                            member_retries=1, base_path='Drive'))
+    assert time.perf_counter() - start < StallingDrive.stall  # retry didn't wait
+    with zipfile.ZipFile(io.BytesIO(zipped)) as zf:
+        assert zf.namelist() == list(files.title)
+    fake.released.set()
+    time.sleep(0.1)  # let stalled attempt finish before the next test
+
+
+def test_prefetched_zip_matches_sequential(use_fake_drive):
+    fake = use_fake_drive(FakeDrive.generate(depth=1, fanout=3, files_per_folder=3,
+                                             file_size=3000))
+    files = drive.file_tree_to_df(fake.drive_id, 'Drive', flat=True)
+    file_ids = list(files.id)
+    fake.media_failures[file_ids[1]] = 1
+    fake.media_delays[file_ids[2]] = 1
+
+    sequential = zipfile.ZipFile(io.BytesIO(b''.join(
+        drive.iter_folder_zip(files.iloc[3:]))))
+    fetched = zipfile.ZipFile(io.BytesIO(b''.join(
+        drive.iter_folder_zip(files, workers=4, member_timeout=0.5, member_retries=1,
+                              spool_size=1000))))
+    missing = zipfile.ZipFile(io.BytesIO(b''.join(
+        drive.iter_folder_zip(files.iloc[:3], workers=4, member_timeout=0.5))))
+
+    fetched_infos = fetched.infolist()
+    assert [i.filename for i in fetched_infos[3:]] == sequential.namelist()
+    for info, seq_info in zip(fetched_infos[3:], sequential.infolist()):
+        assert fetched.read(info) == sequential.read(seq_info)
+    assert len(fetched_infos) == len(files)  # failed and slow members retried
+    assert len(missing.namelist()) == 3
+    assert missing.namelist()[-1] == 'MISSING_FILES.txt'
+    assert b'TimeoutError' in missing.read('MISSING_FILES.txt')
+
+
+def test_closed_prefetch_discards_window(use_fake_drive, monkeypatch):
+    fake = use_fake_drive(FakeDrive.generate(depth=0, files_per_folder=8))
+    files = drive.file_tree_to_df(fake.drive_id, 'Drive', flat=True)
+    opened, closed = [], []
+    init, close = drive._SpooledChunks.__init__, drive._SpooledChunks.close
+    monkeypatch.setattr(drive._SpooledChunks, '__init__',
+                        lambda self, *args: opened.append(self) or init(self, *args))
+    monkeypatch.setattr(drive._SpooledChunks, 'close',
+                        lambda self: closed.append(self) or close(self))
+    count = fake.request_count
+    members = drive.prefetch_members(files, workers=3)
+    r, (chunks, *_) = next(members)
+    list(chunks)
+    members.close()
+
+    deadline = time.perf_counter() + 5
+    while len(closed) < len(opened) - 1 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert set(closed) == set(opened) - {chunks}  # prefetched spools discarded
+    assert fake.request_count - count <= 4  # rows beyond the window never fetched
+
+
+def test_permanent_errors():
+    from googleapiclient.errors import HttpError
+    import httplib2
+
+    def error(status, reason):
+        content = {'error': {'code': status, 'errors': [{'reason': reason}]}}
+        return HttpError(httplib2.Response({'status': status}),
+                         json.dumps(content).encode('utf-8'))
+
+    assert drive.is_permanent_error(error(403, 'fileNotDownloadable'))
+    assert drive.is_permanent_error(error(403, 'exportSizeLimitExceeded'))
+    assert drive.is_permanent_error(HttpError(httplib2.Response({'status': 404}), b''))
+    assert not drive.is_permanent_error(error(403, 'userRateLimitExceeded'))
+    assert not drive.is_permanent_error(error(429, 'rateLimitExceeded'))
+    assert not drive.is_permanent_error(error(500, 'backendError'))
+    assert not drive.is_permanent_error(TimeoutError())
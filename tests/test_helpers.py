@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pandas as pd
+import pytest
+
+from blind_challenge.app.helpers import (atomic_write, save_pickle, load_pickle,
+                                        make_private_dir, parse_timestamp_str,
+                                        parse_timestamps)
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def _listing(n_rows):
+    ids = ['1a2B3c4D5e6F7g8H9i0J{:08d}'.format(i) for i in range(n_rows)]
+    paths = ['Drive > folder {} > sub {}'.format(i % 50, i % 7) for i in range(n_rows)]
+    return pd.DataFrame({
+        'title': ['file {}.pdf'.format(i) for i in range(n_rows)],
+        'date_modified': pd.date_range('2019-01-01', periods=n_rows, freq='min'),
+        'path': paths,
+        'path_show': [p.split(' > ', 1)[1] for p in paths],
+        'date_created': pd.date_range('2018-01-01', periods=n_rows, freq='min'),
+        'icon': 'https://drive-thirdparty.googleusercontent.com/16/type/application/pdf',
+        'id': ids,
+        'kind': 'drive#file',
+        'last_user': [{'displayName': 'User {}'.format(i % 20)} for i in range(n_rows)],
+        'mimeType': 'application/pdf',
+        'url_view': ['https://drive.google.com/file/d/{}/view'.format(i) for i in ids],
+    })
+
+
+def test_atomic_write_keeps_old_file_on_error(tmpdir):
+    path = str(tmpdir.join('data.bin'))
+    with atomic_write(path) as f:
+        f.write(b'old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as f:
+            f.write(b'partial')
+            raise RuntimeError
+    with open(path, 'rb') as f:
+        assert f.read() == b'old'
+    assert os.listdir(str(tmpdir)) == ['data.bin']
+
+
+def test_pickles_kept_private(tmpdir):
+    directory = str(tmpdir.join('snapshots'))
+    make_private_dir(directory)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.chmod(directory, 0o777)
+    make_private_dir(directory)  # access by others is removed
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    path = os.path.join(directory, 'snapshot.pickle')
+    assert load_pickle(path) is None
+    df = _listing(100)
+    save_pickle({'df': df}, path)
+    pd.testing.assert_frame_equal(load_pickle(path)['df'], df)
+    os.chmod(path, 0o666)
+    with pytest.raises(PermissionError):
+        load_pickle(path)
+
+
+def test_parse_timestamps():
+    values = ['2019-{:02d}-{:02d}T10:{:02d}:{:02d}.{:03d}Z'.format(
+        i % 12 + 1, i % 28 + 1, i % 60, i // 60 % 60, i % 1000) for i in range(2000)]
+    values[-1] = None
+    parsed = parse_timestamps(values)
+    assert list(parsed[:-1]) == [parse_timestamp_str(i) for i in values[:-1]]
+    assert (parsed[:-1] == pd.to_datetime(values[:-1], utc=True).tz_convert(None)).all()
+    assert pd.isnull(parsed[-1])
+
+    offsets = parse_timestamps(['2019-01-01T12:00:00+01:00', '2019-01-01T11:00:00Z'])
+    assert offsets[0] == offsets[1] == pd.Timestamp('2019-01-01 11:00')
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import blind_challenge.app as app_module
+from blind_challenge.app import app, drive, routes
+from blind_challenge.fake_drive import FakeDrive
+from blind_challenge.load_test import (serve_fake_drive, run_load, parse_mix,
+                                       percentile, format_report)
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture
+def restore_app(monkeypatch):
+    """Restore app state changed by serve_fake_drive after the test."""
+    for obj, names in [(drive, ['get_files_service', 'get_http']),
+                       (app_module, ['LISTING', 'DOWNLOAD_CACHE', 'ZIP_STORE']),
+                       (routes, ['DOWNLOAD_CACHE', 'ZIP_STORE']),
+                       (app, ['before_first_request_funcs'])]:
+        for name in names:
+            monkeypatch.setattr(obj, name, getattr(obj, name))
+    monkeypatch.setattr(app, 'config', app.config.copy())
+    monkeypatch.setattr(app_module, 'TABLE_DICT', app_module.TABLE_DICT.copy())
+    yield
+    app_module.TABLE_DICT.clear()
+
+
+def test_parse_mix_and_percentile():
+    assert parse_mix('browse=1, download=3,zip_drive=0') == {'browse': 1, 'download': 3}
+    with pytest.raises(ValueError):
+        parse_mix('upload=1')
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_load_run(restore_app, tmpdir):
+    fake = FakeDrive.generate(depth=1, fanout=2, files_per_folder=3, docs_per_folder=1)
+    serve_fake_drive(fake, 'Drive', 'secret', str(tmpdir), prebuild_zips=False)
+    stats, elapsed = run_load(app, 'secret', users=4, duration=0.5, think_time=0.05,
+                              mix='browse=1,download=2,zip_folder=1,zip_selected=1')
+    assert len(stats['login'].latencies) == 4
+    assert len(stats['browse'].latencies) >= 4 and stats['download'].latencies
+    assert sum(s.errors for s in stats.values()) == 0
+    assert stats['download'].bytes > 0 and stats['download'].max_rss > 0
+    report = format_report(stats, elapsed)
+    assert 'zip_selected' in report and 'zip_drive' not in report
+
+    # a wrong password gets requests sent back to the login page, counted as errors
+    stats, elapsed = run_load(app, 'wrong', users=1, duration=0, mix='download=1')
+    assert stats['browse'].errors == 1
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from blind_challenge.app.metrics import Registry, Counter, Gauge, Histogram
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    requests = Counter('requests_total', 'Requests.', ['method', 'status'], registry=registry)
+    size = Gauge('size', 'Size.', registry=registry)
+    latency = Histogram('latency_seconds', 'Latency.', buckets=[0.1, 1], registry=registry)
+    requests.labels('list', 'ok').inc()
+    requests.labels('list', 'ok').inc(2)
+    requests.labels('get', '4"04').inc()
+    size.labels().set_function(lambda: 7)
+    for value in [0.05, 0.1, 0.5, 3]:
+        latency.observe(value)
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{method="get",status="4\\"04"} 1',
+        'requests_total{method="list",status="ok"} 3',
+        '# HELP size Size.',
+        '# TYPE size gauge',
+        'size 7',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 3.65',
+        'latency_seconds_count 4',
+    ]
+    with pytest.raises(ValueError):
+        requests.labels('list')
+    with pytest.raises(ValueError):
+        Counter('size', 'Duplicate.', registry=registry)
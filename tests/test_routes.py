@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+from types import SimpleNamespace
+import zipfile
+
+import pytest
+from flask import g
+
+import blind_challenge.app as app_module
+from blind_challenge.app import app, drive, routes, TABLE_DICT
+from blind_challenge.app.search import SearchIndex
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture
+def client(fake_drive, monkeypatch):
+    """Test client serving the fake drive listing as drive 'Drive'."""
+    files = drive.file_tree_to_df(fake_drive.drive_id, 'Drive', flat=True)
+    table = SimpleNamespace(df=files, current_df=files, cols_show=['title'],
+                            index=drive.index_files(files, 'Drive'),
+                            search_index=SearchIndex(files, 'Drive'), is_stale=False)
+    monkeypatch.setitem(TABLE_DICT, 'Drive', table)
+    monkeypatch.setattr(app_module, 'LISTING', app_module.LISTING)
+    app_module.publish_listing()
+    monkeypatch.setattr(app, 'before_first_request_funcs', [])
+    monkeypatch.setitem(app.config, 'LOGIN_DISABLED', True)
+    monkeypatch.setattr(routes, 'ZIP_STORE', None)
+    monkeypatch.setattr(routes, 'DOWNLOAD_CACHE', None)
+    with app.test_client() as client:
+        yield client
+
+
+def zip_names(response):
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+        return zf.namelist()
+
+
+def test_selective_zips(client, fake_drive, monkeypatch):
+    files = TABLE_DICT['Drive'].df
+    assert len(zip_names(client.get('/build_zip/Drive'))) == len(files)
+    assert client.get('/build_zip/Other').status_code == 404
+
+    path = files.path[files.path.str.count(' > ') == 1].iloc[0]
+    in_folder = (files.path == path) | files.path.str.startswith(path + ' > ')
+    names = zip_names(client.get('/build_zip/Drive', query_string={'path': path}))
+    assert len(names) == in_folder.sum() < len(files)
+    assert set(files.title[files.path == path]) <= set(names)  # named below folder
+
+    selected = list(files.id[:3])
+    names = zip_names(client.post('/build_zip/selected', data={'file_id': selected}))
+    assert len(names) == 3
+    assert client.post('/build_zip/selected').status_code == 302
+
+    # files deleted since listing are left out only if checked before zipping
+    fake_drive.delete_file(files.id.iloc[0])
+    assert 'MISSING_FILES.txt' in zip_names(client.get('/build_zip/Drive'))
+    monkeypatch.setitem(app.config, 'ZIP_REVALIDATE', True)
+    names = zip_names(client.get('/build_zip/Drive'))
+    assert len(names) == len(files) - 1 and 'MISSING_FILES.txt' not in names
+
+
+def test_download_uses_index(client):
+    files = TABLE_DICT['Drive'].df
+    record = TABLE_DICT['Drive'].index[files.id.iloc[-1]]
+    assert record.drive == 'Drive' and record.title == files.title.iloc[-1]
+    response = client.get('/download/{}'.format(record.id))
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == 'attachment; filename="{}"'.format(
+        record.title)
+    assert client.get('/download/missing').status_code == 302
+
+
+def test_listing_snapshot_swap(client):
+    old = app_module.LISTING
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        assert g.listing is old and g.tables['Drive'] is old.tables['Drive']
+        table = TABLE_DICT['Drive']
+        table.current_df = table.current_df.iloc[:3]
+        table.index = drive.index_files(table.current_df, 'Drive')
+        app_module.publish_listing(table)
+        # request keeps its snapshot while new requests get the new one
+        assert len(g.tables['Drive']) > 3 and g.listing.version == old.version
+    assert app_module.LISTING.version == old.version + 1
+    assert len(app_module.LISTING.file_index) == 3
+    with pytest.raises(AttributeError):
+        old.tables = {}
+
+
+def test_browse_page_cached_per_listing(client, monkeypatch):
+    renders = []
+    render_browse = routes.render_browse
+    monkeypatch.setattr(routes, 'render_browse', lambda listing: renders.append(1) or
+                        render_browse(listing))
+    first = client.get('/')
+    assert first.status_code == 200 and first.headers['ETag']
+    assert client.get('/', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert client.get('/').get_data() == first.get_data()
+    assert len(renders) == 1
+
+    table = TABLE_DICT['Drive']
+    table.current_df = table.current_df.iloc[:3]
+    app_module.publish_listing(table)
+    second = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200 and second.headers['ETag'] != first.headers['ETag']
+    assert len(renders) == 2
+
+
+def test_metrics(client):
+    files = TABLE_DICT['Drive'].df
+    client.get('/download/{}'.format(files.id.iloc[0]))
+    client.get('/build_zip/Drive')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    for sample in ['blind_http_requests_total{endpoint="download",status="200"}',
+                   'blind_drive_api_requests_total{method="drive.files.get_media",status="ok"}',
+                   'blind_download_bytes_total{source="drive"}',
+                   'blind_zip_responses_total{source="streamed"}',
+                   'blind_zip_build_seconds_count']:
+        assert sample in text
+
+
+def test_profiling(client, fake_drive, tmpdir, monkeypatch):
+    from blind_challenge.app.admin import DriveTable
+    from blind_challenge.app.profiling import ProfileStore
+
+    store = ProfileStore(str(tmpdir), keep=3)
+    monkeypatch.setattr(routes, 'PROFILE_STORE', store)
+    monkeypatch.setattr(app_module, 'PROFILE_STORE', store)
+    monkeypatch.setitem(app.config, 'PROFILE_TOKEN', 'sesame')
+    client.get('/')
+    client.get('/', headers={'X-Profile-Token': 'wrong'})
+    assert store.recent() == []
+    client.get('/', headers={'X-Profile-Token': 'sesame'})
+    client.get('/download/missing', query_string={'profile': 'sesame'})
+    assert [i['label'] for i in store.recent()] == ['GET /download/missing', 'GET /']
+
+    monkeypatch.setitem(app.config, 'PROFILE_REFRESHES', True)
+    DriveTable(fake_drive.drive_id, 'Drive')
+    for i in range(2):
+        client.get('/', headers={'X-Profile-Token': 'sesame'})
+    profiles = store.recent()
+    assert len(profiles) == 3 and 'refresh' in [i['kind'] for i in profiles]
+
+    assert client.get('/admin/profiles').status_code == 404
+    page = client.get('/admin/profiles', query_string={'token': 'sesame'})
+    assert page.status_code == 200 and profiles[0]['name'] in page.get_data(as_text=True)
+    name = profiles[-1]['name']
+    page = client.get('/admin/profiles', query_string={'name': name})
+    assert 'function calls' in page.get_data(as_text=True)
+    prof = client.get('/admin/profiles/{}.prof'.format(name))
+    assert prof.status_code == 200 and len(prof.get_data())
+
+
+def test_search_page(client, monkeypatch):
+    files = TABLE_DICT['Drive'].df
+    assert 'id="search-form"' in client.get('/').get_data(as_text=True)
+    page = client.get('/search', query_string={'q': 'file 3', 'mime': 'application/pdf'})
+    html = page.get_data(as_text=True)
+    matching = files[files.title == 'file 3.pdf']
+    assert html.count('name="file_id"') == len(matching) > 0
+    assert matching.id.iloc[0] in html
+
+    searches = []
+    monkeypatch.setattr(SearchIndex, 'search', lambda *args, **kwargs: searches.append(args))
+    page = client.get('/search', query_string={'q': 'file', 'before': 'yesterday'})
+    html = page.get_data(as_text=True)
+    assert 'Dates should be given as' in html
+    assert not searches and 'found.' not in html
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+import pandas as pd
+
+from blind_challenge.app.search import SearchIndex, search, tokenize
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def make_listing(rows):
+    return pd.DataFrame(rows, columns=['id', 'title', 'path_show', 'mimeType',
+                                       'date_modified'])
+
+
+LISTING = make_listing([
+    ('a', 'Final Report.pdf', 'Results', 'application/pdf', datetime(2019, 3, 1)),
+    ('b', 'Reporting guidelines', 'Rules', 'application/vnd.google-apps.document',
+     datetime(2019, 1, 5)),
+    ('c', 'Gel image', 'Results > Report figures', 'image/png', datetime(2019, 2, 1)),
+    ('d', 'Résumé', 'Team', 'application/pdf', pd.NaT),
+])
+
+
+def test_tokenize():
+    assert tokenize('Résumé_v2 (Final).PDF') == ['resume_v2', 'final', 'pdf']
+    assert tokenize(None) == []
+
+
+def test_search_ranking_and_filters():
+    index = SearchIndex(LISTING, 'Drive')
+    # whole-word title match beats prefix title match beats folder match
+    assert [h.id for h in index.search('report')] == ['a', 'b', 'c']
+    assert [h.id for h in index.search('rep fig')] == ['c']
+    assert [h.id for h in index.search('resume')] == ['d']
+    assert index.search('missing') == [] and len(index.search('')) == 4
+    assert [h.id for h in index.search('report', mime='application/pdf')] == ['a']
+    assert [h.id for h in index.search('', mime='image/')] == ['c']
+    hits = index.search('report', modified_after=datetime(2019, 1, 6),
+                        modified_before=datetime(2019, 3, 1))
+    assert [h.id for h in hits] == ['c']
+    assert index.search('report', limit=1)[0].drive == 'Drive'
+
+    other = SearchIndex(make_listing([('e', 'Report', 'Other', 'text/plain', pd.NaT)]),
+                        'Other')
+    assert [h.id for h in search([index, other], 'report', limit=2)] == ['a', 'e']
+
+
+def test_search_index_updates_from_changes(monkeypatch):
+    from blind_challenge.app import search as search_module
+
+    index = SearchIndex(LISTING, 'Drive')
+    changed = LISTING.copy()
+    changed.loc[1, 'title'] = 'Judging criteria'
+    changed = pd.concat([changed.drop(3), make_listing([
+        ('e', 'Poster', 'Results', 'application/pdf', datetime(2019, 4, 1))])])
+    calls = []
+    tokenize = search_module.tokenize
+    monkeypatch.setattr(search_module, 'tokenize', lambda text: calls.append(text) or
+                        tokenize(text))
+    updated = SearchIndex(changed, 'Drive', previous=index)
+    assert calls == ['Judging criteria', 'Rules', 'Poster', 'Results']
+    assert [h.id for h in updated.search('report')] == ['a', 'c']
+    assert [h.id for h in updated.search('judg')] == ['b']
+    fresh = SearchIndex(changed, 'Drive')
+    for query in ('', 'report', 'rep', 'results', 'res', 'resume', 'poster', 'guidelines'):
+        assert updated.search(query) == fresh.search(query)
+    assert updated._vocab == fresh._vocab
+    # previous index, still in use until the new one is published, is unchanged
+    assert [h.id for h in index.search('rep')] == ['a', 'b', 'c']
+    assert [h.id for h in index.search('resume')] == ['d']
+
+
+def test_search_large_listing():
+    listing = make_listing([('id{}'.format(i), 'file {} report {}.pdf'.format(i, i % 97),
+                             'folder {} > sub {}'.format(i % 50, i % 7), 'application/pdf',
+                             datetime(2019, 1, 1)) for i in range(50000)])
+    hits = SearchIndex(listing, 'Drive').search('report 42 sub', limit=20)
+    assert len(hits) == 20 and all(' 42.pdf' in h.title for h in hits)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+import blind_challenge
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+HEAVY_MODULES = ('pandas', 'numpy', 'googleapiclient.discovery', 'google.oauth2')
+
+
+def test_heavy_modules_imported_lazily():
+    src_dir = os.path.dirname(os.path.dirname(blind_challenge.__file__))
+    env = dict(os.environ, PYTHONPATH=src_dir)
+    code = ('import sys, blind_challenge.app; '
+            'print(",".join(m for m in {!r} if m in sys.modules))'.format(HEAVY_MODULES))
+    proc = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    assert proc.stdout.strip() == ''  # heavy modules wait until first used
+
+
+def test_service_built_from_saved_discovery(tmpdir, monkeypatch):
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient import discovery
+    from blind_challenge.app.admin import build_service
+
+    credentials = AnonymousCredentials()
+    service = build_service('drive', 'v3', credentials, discovery_dir=str(tmpdir))
+    assert tmpdir.join('drive.v3.json').check()
+
+    def build(*args, **kwargs):
+        raise AssertionError('discovery document fetched again')
+
+    monkeypatch.setattr(discovery, 'build', build)
+    cached = build_service('drive', 'v3', credentials, discovery_dir=str(tmpdir))
+    assert cached._baseUrl == service._baseUrl
+    assert hasattr(cached, 'files') and hasattr(cached, 'changes')